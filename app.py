@@ -1,45 +1,155 @@
 #!/usr/bin/env python3
 # filepath: c:\Users\DELL\Documents\StegaMarkStart-V2.0\app.py
 import argparse
-from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError, features
 import io
 import os
 import sys
 import math
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+import glob
+import time
+import signal
+import socket
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import struct
+import zipfile
+import mmap
+import zlib
+import bz2
+import json
+import uuid
+import tempfile
+import numpy as np
+from flask import Flask, Request, Response, g, render_template, request, jsonify, send_file, send_from_directory, stream_with_context
 import base64 # Potentially useful for returning small images/data
 import traceback # Import traceback at the top
 from werkzeug.exceptions import HTTPException # Import HTTPException
+from werkzeug.serving import BaseWSGIServer
+try:
+    import resource # Peak RSS for benchmarks (not available on Windows)
+except ImportError:
+    resource = None
+try:
+    import lzma # Optional payload compression (missing from some minimal Python builds)
+except ImportError:
+    lzma = None
 
 # --- Helper: Data Conversion ---
 
+def pack_bit_groups(data, width):
+    """
+    Splits bytes into consecutive groups of `width` bits, MSB first.
+
+    The last group is zero-padded when the bit count is not a multiple of `width`,
+    e.g. pack_bit_groups(b"\\xb4", 3) -> [5, 5, 0] (101 101 00).
+
+    Args:
+        data (bytes): The bytes to split (anything supporting the buffer protocol).
+        width (int): Bits per group, 1-8.
+
+    Returns:
+        np.ndarray: uint8 array with one value per group.
+    """
+    if not 1 <= width <= 8:
+        raise ValueError(f"Bit group width must be between 1 and 8, got {width}")
+    data_array = np.frombuffer(data, dtype=np.uint8)
+    if width == 8:
+        return data_array.copy()
+    if width == 1:
+        return np.unpackbits(data_array)
+    if 8 % width == 0: # Whole groups per byte (2 or 4 bits): shift each one out directly
+        per_byte = 8 // width
+        values = np.empty((data_array.size, per_byte), dtype=np.uint8)
+        for i in range(per_byte):
+            values[:, i] = (data_array >> (8 - width * (i + 1))) & ((1 << width) - 1)
+        return values.reshape(-1)
+
+    # Other widths: every `width` bytes hold exactly 8 groups, so read the bytes in chunks of
+    # `width` as one 64-bit integer and shift the 8 groups out of it
+    n_bytes = data_array.size
+    n_chunks = -(-n_bytes // width) # Ceiling division
+    chunks = np.zeros((n_chunks, width), dtype=np.uint8)
+    chunks.reshape(-1)[:n_bytes] = data_array # Zero padding fills the last chunk
+    chunk_bits = np.zeros(n_chunks, dtype=np.uint64)
+    for j in range(width):
+        chunk_bits = (chunk_bits << np.uint64(8)) | chunks[:, j]
+    values = np.empty((n_chunks, 8), dtype=np.uint8)
+    for i in range(8):
+        values[:, i] = (chunk_bits >> np.uint64(width * (7 - i))) & np.uint64((1 << width) - 1)
+    return values.reshape(-1)[:-(-n_bytes * 8 // width)]
+
+def bit_groups_to_bits(values, width):
+    """Expands group values of `width` bits (see pack_bit_groups) into a flat 0/1 uint8 array, MSB first."""
+    values = np.asarray(values, dtype=np.uint8)
+    if width == 8:
+        return np.unpackbits(values)
+    shifts = np.arange(width - 1, -1, -1, dtype=np.uint8)
+    return ((values[:, None] >> shifts) & 1).reshape(-1)
+
+def unpack_bit_groups(values, width):
+    """
+    Reassembles bytes from group values of `width` bits; the inverse of pack_bit_groups.
+
+    Only the low `width` bits of each value are used. Trailing bits that do not fill a whole byte are dropped.
+
+    Returns:
+        bytes: The packed bytes.
+    """
+    if not 1 <= width <= 8:
+        raise ValueError(f"Bit group width must be between 1 and 8, got {width}")
+    values = np.asarray(values, dtype=np.uint8)
+    if width == 8:
+        return values.tobytes()
+    values = values & ((1 << width) - 1)
+    if width == 1:
+        return np.packbits(values[:values.size - values.size % 8]).tobytes()
+    if 8 % width == 0: # Whole groups per byte (2 or 4 bits): shift each one back in directly
+        per_byte = 8 // width
+        n_bytes = values.size // per_byte
+        packed = np.zeros(n_bytes, dtype=np.uint8)
+        for i in range(per_byte):
+            packed |= values[i:n_bytes * per_byte:per_byte] << (8 - width * (i + 1))
+        return packed.tobytes()
+
+    # Other widths: 8 groups make `width` whole bytes (the reverse of pack_bit_groups)
+    n_bytes = values.size * width // 8
+    n_chunks = -(-n_bytes // width)
+    groups = np.zeros((n_chunks, 8), dtype=np.uint8)
+    n_values = min(values.size, n_chunks * 8)
+    groups.reshape(-1)[:n_values] = values[:n_values]
+    chunk_bits = np.zeros(n_chunks, dtype=np.uint64)
+    for i in range(8):
+        chunk_bits = (chunk_bits << np.uint64(width)) | groups[:, i]
+    chunks = np.empty((n_chunks, width), dtype=np.uint8)
+    for j in range(width):
+        chunks[:, j] = (chunk_bits >> np.uint64(8 * (width - 1 - j))) & np.uint64(0xFF)
+    return chunks.reshape(-1)[:n_bytes].tobytes()
+
 def to_binary(data):
-    """Convert data (string or bytes) to a binary string."""
+    """Convert data (string or bytes) to a binary string. Compatibility wrapper; use pack_bit_groups for new code."""
     if isinstance(data, str):
         # Encode string to bytes using UTF-8, then convert bytes to binary
-        return ''.join(format(byte, '08b') for byte in data.encode('utf-8'))
-    elif isinstance(data, bytes):
-        # Convert bytes directly to binary
-        return ''.join(format(byte, '08b') for byte in data)
-    else:
+        data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
         raise TypeError("Input must be a string or bytes for binary conversion.")
+    return (pack_bit_groups(data, 1) + ord('0')).tobytes().decode('ascii')
 
 def binary_to_bytes(binary_string):
-    """Convert binary string back to bytes."""
+    """Convert binary string back to bytes. Compatibility wrapper; use unpack_bit_groups for new code."""
     # Ensure the string length is a multiple of 8
     byte_len = len(binary_string) // 8
-    actual_binary = binary_string[:byte_len*8] # Trim excess bits that don't form a full byte
-
-    byte_list = bytearray()
-    for i in range(0, len(actual_binary), 8):
-        byte = actual_binary[i:i+8]
-        try:
-            byte_list.append(int(byte, 2))
-        except ValueError:
-            # This might happen if non-binary characters are present
-            print(f"Warning: Skipping invalid binary sequence '{byte}' during conversion.", file=sys.stderr)
-            continue # Or raise an error depending on desired strictness
-    return bytes(byte_list)
+    # Non-ASCII characters become '?' so every character keeps its position (and is rejected below)
+    chars = np.frombuffer(binary_string[:byte_len * 8].encode('ascii', errors='replace'), dtype=np.uint8)
+    bits = (chars - ord('0')).reshape(byte_len, 8)
+    valid = (bits <= 1).all(axis=1) # uint8 wrap-around makes characters below '0' large too
+    if not valid.all():
+        # This might happen if non-binary characters are present
+        print(f"Warning: Skipping {int((~valid).sum())} invalid binary sequence(s) during conversion.", file=sys.stderr)
+    return unpack_bit_groups(bits[valid].reshape(-1), 1)
 
 # --- Helper: Color Conversion ---
 
@@ -53,6 +163,439 @@ def hex_to_rgb(hex_color):
     except ValueError:
         return (255, 255, 255) # Default to white on error
 
+# --- Helper: Caching ---
+
+class LRUCache:
+    """A bounded, thread-safe least-recently-used cache with hit/miss statistics."""
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=len):
+        """
+        Args:
+            maxsize (int): Maximum number of entries kept before the least recently used is evicted.
+            maxbytes (int, optional): Also evict while the summed size of the values exceeds this.
+                A single value larger than maxbytes is not cached at all.
+            sizeof (callable): Returns the size in bytes of a value; only used with maxbytes.
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key` (marking it recently used), or `default` on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entries beyond maxsize/maxbytes."""
+        with self._lock:
+            if self.maxbytes is not None:
+                size = self._sizeof(value)
+                if key in self._entries:
+                    self._nbytes -= self._sizeof(self._entries.pop(key))
+                if size > self.maxbytes:
+                    # Storing it would evict everything, itself included; keep the smaller entries instead
+                    return
+                self._nbytes += size
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while self._entries and (len(self._entries) > self.maxsize or
+                                     (self.maxbytes is not None and self._nbytes > self.maxbytes)):
+                _, evicted = self._entries.popitem(last=False)
+                if self.maxbytes is not None:
+                    self._nbytes -= self._sizeof(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all entries and resets the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns a dict with hits, misses, evictions, current size and maxsize."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._entries), "maxsize": self.maxsize}
+
+def _write_file_atomic(path, data):
+    """Writes `data` to a temporary file next to `path` and renames it into place, so readers never see partial files."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+class DiskLRUCache:
+    """
+    A size-bounded least-recently-used cache of byte strings, one file per entry in a directory.
+
+    Recency is the file modification time, refreshed on every hit, so several processes can
+    share the directory. Keys must be safe file names (e.g. hex digests).
+    """
+
+    def __init__(self, root, maxbytes):
+        """
+        Args:
+            root (str): Directory holding the entries; created if missing.
+            maxbytes (int): Total size of the entries above which the least recently used are deleted.
+        """
+        self.root = root
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key, default=None):
+        """Returns the bytes cached under `key` (marking them recently used), or `default` on a miss."""
+        path = os.path.join(self.root, key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores `value` under `key`, then deletes the least recently used entries beyond maxbytes."""
+        _write_file_atomic(os.path.join(self.root, key), value)
+        self._evict()
+
+    def _evict(self):
+        try:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.root)
+                       if e.is_file() and not e.name.startswith('.')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try: os.remove(path)
+            except OSError: continue # Already evicted by another process
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Returns a dict with hits, misses and evictions."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# --- Helper: Streaming Archives ---
+
+class _ZipStreamSink:
+    """Write-only, non-seekable file object for zipfile that hands out the bytes written so far."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Returns (and forgets) everything written since the last drain."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_zip_stream(entries):
+    """
+    Builds a ZIP archive incrementally, yielding its bytes as each entry is added.
+
+    Entries are stored uncompressed (images are already compressed). Only one entry is held
+    in memory at a time, so the archive can be sent or written while later entries are produced.
+
+    Args:
+        entries: Iterable of (archive name, bytes) pairs.
+
+    Yields:
+        bytes: Consecutive chunks of the archive.
+    """
+    sink = _ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain() # Central directory, written on close
+
+def iter_bounded(executor, fn, items, max_in_flight):
+    """
+    Like executor.map, but keeps at most `max_in_flight` items submitted at once.
+
+    Results are yielded in input order as futures. Holding results back until they are consumed
+    bounds memory by the number of in-flight items instead of the number of items.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+# --- Helper: Strip Processing ---
+
+# Pixels per horizontal band when processing large images strip by strip (bounds peak memory)
+STRIP_PIXELS = int(os.environ.get('STEGAMARK_STRIP_PIXELS', 1 << 20))
+
+def _band_rows(width):
+    """Number of image rows per band so one band holds about STRIP_PIXELS pixels."""
+    return max(1, STRIP_PIXELS // max(1, width))
+
+def _split_ranges(total, max_size, threads=1, multiple=1, min_size=1):
+    """
+    Splits range(total) into consecutive (start, stop) ranges of at most `max_size` items.
+
+    With several threads the ranges are made small enough for every thread to get one, but
+    not smaller than `min_size`. Range sizes are rounded down to a multiple of `multiple`
+    (except for the last range).
+    """
+    size = min(max_size, max(min_size, -(-total // threads))) if threads > 1 else max_size
+    size = max(multiple, size - size % multiple)
+    return [(start, min(total, start + size)) for start in range(0, total, size)]
+
+def _map_ranges(fn, ranges, threads=1):
+    """
+    Yields fn(start, stop) for each range in order, computing up to `threads` of them at once.
+
+    NumPy and Pillow release the GIL for large array and image operations, so bands of one image
+    are processed on several cores. At most 2 * threads results are held at once.
+    """
+    if threads <= 1 or len(ranges) <= 1:
+        for start, stop in ranges:
+            yield fn(start, stop)
+        return
+    with ThreadPoolExecutor(max_workers=min(threads, len(ranges))) as executor:
+        for future in iter_bounded(executor, lambda item: fn(*item), ranges, threads * 2):
+            yield future.result()
+
+def _load_for_threads(image, threads):
+    """Decodes a lazily opened image once, before several threads crop bands from it."""
+    if threads > 1:
+        image.load()
+
+def _rgba_channels(image, n_rows=None, threads=1):
+    """
+    Flat RGBA channel values of the first `n_rows` rows of an image (all rows by default).
+
+    With several threads the rows are converted band by band in parallel into one array.
+    """
+    width, height = image.size
+    n_rows = height if n_rows is None else min(height, n_rows)
+    if threads <= 1:
+        region = image if n_rows == height else image.crop((0, 0, width, n_rows))
+        return np.asarray(region.convert("RGBA")).reshape(-1)
+
+    _load_for_threads(image, threads)
+    channels = np.empty((n_rows, width, 4), dtype=np.uint8)
+    def convert_band(y0, y1):
+        channels[y0:y1] = np.asarray(image.crop((0, y0, width, y1)).convert("RGBA"))
+    for _ in _map_ranges(convert_band, _split_ranges(n_rows, _band_rows(width), threads), threads):
+        pass
+    return channels.reshape(-1)
+
+# --- Helper: Compression ---
+
+# Codecs for compressing hidden payloads; the ids are what payload headers store
+COMPRESSION_CODECS = {"none": 0, "zlib": 1, "lzma": 2, "bz2": 3}
+# Largest payload a decompression may produce, so a crafted image cannot expand into unbounded memory
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('STEGAMARK_MAX_DECOMPRESSED_BYTES', 64 * 1024 * 1024))
+_DECOMPRESSION_ERRORS = (zlib.error, EOFError, OSError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+def available_codecs():
+    """Names of the compression codecs usable in this Python build ('lzma' may be missing)."""
+    return [name for name in COMPRESSION_CODECS if name != "lzma" or lzma is not None]
+
+# 'auto' compression shortcuts: payloads smaller than this are stored as-is (codec headers outweigh any saving)
+AUTO_COMPRESSION_MIN_BYTES = 64
+# bz2 and lzma only compete from this size; below it their larger headers always lose to zlib
+AUTO_COMPRESSION_HEAVY_MIN_BYTES = 4096
+# Leading bytes compressed with zlib level 1 to recognize data that is already compressed (PNG, JPEG, ...)
+AUTO_COMPRESSION_PROBE_BYTES = 64 * 1024
+
+def compress_bytes(data, codec):
+    """
+    Compresses `data` with the named codec ('none' returns it unchanged).
+
+    Raises:
+        ValueError: For an unknown or unavailable codec.
+    """
+    if codec not in available_codecs():
+        raise ValueError(f"Unsupported compression: {codec}")
+    if codec == "zlib":
+        return zlib.compress(data, 9)
+    if codec == "bz2":
+        return bz2.compress(data, 9)
+    if codec == "lzma":
+        return lzma.compress(data, preset=6) # Preset 9 needs ~700 MB to compress and rarely helps payload-sized data
+    return bytes(data)
+
+def compress_smallest(data, codecs=None):
+    """
+    Compresses `data` with every codec and keeps the smallest result (which may be uncompressed).
+
+    Trials that cannot win are skipped: tiny payloads and data that is already compressed are
+    stored as-is, and bz2/lzma are only tried on payloads of AUTO_COMPRESSION_HEAVY_MIN_BYTES or more.
+
+    Returns:
+        tuple: (codec name, compressed bytes)
+    """
+    codecs = list(codecs or available_codecs())
+    if "none" in codecs:
+        if len(data) < AUTO_COMPRESSION_MIN_BYTES:
+            return "none", bytes(data)
+        probe = data[:AUTO_COMPRESSION_PROBE_BYTES]
+        if len(zlib.compress(probe, 1)) >= len(probe) * 0.95: # Less than 5% saving: already compressed
+            return "none", bytes(data)
+    if len(data) < AUTO_COMPRESSION_HEAVY_MIN_BYTES:
+        codecs = [codec for codec in codecs if codec not in ("bz2", "lzma")] or codecs
+    results = ((codec, compress_bytes(data, codec)) for codec in codecs)
+    return min(results, key=lambda result: len(result[1]))
+
+def decompress_bytes(data, codec, max_size=None):
+    """
+    Reverses compress_bytes, refusing to produce more than `max_size` bytes (default MAX_DECOMPRESSED_BYTES).
+
+    Raises:
+        ValueError: If the codec is unknown or unavailable, the data is damaged, or the output is too large.
+    """
+    if codec not in available_codecs():
+        raise ValueError(f"Unsupported compression: {codec}")
+    if codec == "none":
+        return bytes(data)
+    max_size = MAX_DECOMPRESSED_BYTES if max_size is None else max_size
+    if codec == "zlib":
+        decompressor = zlib.decompressobj()
+    elif codec == "bz2":
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        decompressor = lzma.LZMADecompressor()
+    try:
+        output = decompressor.decompress(data, max_size + 1)
+    except _DECOMPRESSION_ERRORS as e:
+        raise ValueError(f"Damaged {codec} payload: {e}")
+    if len(output) > max_size:
+        raise ValueError(f"Decompressed payload exceeds {max_size} bytes.")
+    if not decompressor.eof:
+        raise ValueError(f"Damaged {codec} payload: compressed data is truncated.")
+    return output
+
+# --- Helper: Payload Container ---
+
+# Binary container for the typed payloads written by the web app (text or image watermarks):
+# magic, kind, compression, length of the format name, format name (ASCII), then the content.
+# It replaces the older {"watermark_type": ..., "content": base64} JSON, which is still read.
+PAYLOAD_MAGIC = b"\x89SMP" # 0x89 is never the first byte of UTF-8 text or JSON
+PAYLOAD_STRUCT = struct.Struct(">4sBBB")
+PAYLOAD_KINDS = {"text": 1, "image": 2}
+
+def pack_payload(kind, content, fmt="", compression="auto"):
+    """
+    Packs typed watermark content into the binary payload container.
+
+    Args:
+        kind (str): 'text' or 'image'.
+        content (bytes): The raw content (UTF-8 text or encoded image bytes).
+        fmt (str): Format of the content, e.g. 'png' for images.
+        compression (str): A name from COMPRESSION_CODECS, or 'auto' for the smallest result.
+
+    Returns:
+        bytes: The container.
+
+    Raises:
+        ValueError: For an unknown kind or compression.
+    """
+    if kind not in PAYLOAD_KINDS:
+        raise ValueError(f"Unknown payload kind: {kind}")
+    if compression == "auto":
+        compression, body = compress_smallest(content)
+    else:
+        body = compress_bytes(content, compression)
+    fmt_bytes = fmt.encode('ascii')
+    header = PAYLOAD_STRUCT.pack(PAYLOAD_MAGIC, PAYLOAD_KINDS[kind], COMPRESSION_CODECS[compression], len(fmt_bytes))
+    return header + fmt_bytes + body
+
+def unpack_payload(data):
+    """
+    Reads a payload container written by pack_payload.
+
+    Returns:
+        dict | None: {"watermark_type", "format", "content" (bytes)}, or None if `data` is not a container.
+
+    Raises:
+        ValueError: If the container is damaged or uses an unknown kind or compression.
+    """
+    if len(data) < PAYLOAD_STRUCT.size or bytes(data[:len(PAYLOAD_MAGIC)]) != PAYLOAD_MAGIC:
+        return None
+    _, kind_id, compression_id, fmt_len = PAYLOAD_STRUCT.unpack_from(data)
+    kinds = {value: name for name, value in PAYLOAD_KINDS.items()}
+    codecs = {value: name for name, value in COMPRESSION_CODECS.items()}
+    if kind_id not in kinds or compression_id not in codecs:
+        raise ValueError(f"Unsupported payload container (kind {kind_id}, compression {compression_id})")
+    body_start = PAYLOAD_STRUCT.size + fmt_len
+    fmt = bytes(data[PAYLOAD_STRUCT.size:body_start]).decode('ascii', errors='replace')
+    body = decompress_bytes(bytes(data[body_start:]), codecs[compression_id])
+    return {"watermark_type": kinds[kind_id], "format": fmt, "content": body}
+
+# --- Helper: Keyed Pixel Order ---
+
+# Keyed pixel permutations are costly to generate for large images, so they are kept per (key digest, pixel count).
+# Each costs 4 bytes per pixel: the default 256 MB budget holds one permutation of up to ~67 MP; larger images
+# are not cached unless STEGAMARK_PERMUTATION_CACHE_BYTES is raised.
+permutation_cache = LRUCache(maxsize=int(os.environ.get('STEGAMARK_PERMUTATION_CACHE_SIZE', 8)),
+                             maxbytes=int(os.environ.get('STEGAMARK_PERMUTATION_CACHE_BYTES', 256 * 1024 * 1024)),
+                             sizeof=lambda order: order.nbytes)
+
+def keyed_pixel_order(key, n_pixels):
+    """
+    Returns the secret-keyed pseudo-random order in which keyed embedding visits the pixels of an image.
+
+    The permutation is seeded from the SHA-256 of the key, computed once per key and pixel
+    count and then served from `permutation_cache`.
+
+    Args:
+        key (str | bytes): The embedding key.
+        n_pixels (int): Number of pixels in the image.
+
+    Returns:
+        np.ndarray: Read-only uint32 permutation of range(n_pixels).
+    """
+    digest = hashlib.sha256(key.encode('utf-8') if isinstance(key, str) else bytes(key)).digest()
+    cache_key = (digest, n_pixels) # The digest, not the key itself, so the secret is not kept around
+    order = permutation_cache.get(cache_key)
+    if order is None:
+        order = np.random.default_rng(int.from_bytes(digest, 'big')).permutation(n_pixels).astype(np.uint32)
+        order.flags.writeable = False # Shared between threads and requests
+        permutation_cache.put(cache_key, order)
+    return order
+
 # --- LSB Steganography Core (Refactored for PIL Image objects) ---
 
 class LSBSteganography:
@@ -60,15 +603,61 @@ class LSBSteganography:
 
     # Using a more robust sequence that's less likely to appear naturally
     DELIMITER = b"<\x01STG\x02MRK\x03END>"
-    DELIMITER_BIN = to_binary(DELIMITER)
-    DELIMITER_LEN_BITS = len(DELIMITER_BIN)
-
-    def __init__(self, strength=3):
+    DELIMITER_BIN = to_binary(DELIMITER) # Kept for compatibility; the codec works on bytes
+    DELIMITER_LEN_BITS = len(DELIMITER) * 8
+
+    # Payload formats: v1 = payload + DELIMITER, v2 = fixed-size header + payload
+    FORMAT_LEGACY = 1
+    FORMAT_V2 = 2
+
+    # v2 header: magic, version, strength, flags, payload length, CRC32 of payload (both as stored)
+    HEADER_MAGIC = b"\x89SMK"
+    HEADER_STRUCT = struct.Struct(">4sBBBII")
+    HEADER_SIZE = HEADER_STRUCT.size # 15 bytes
+    HEADER_LEN_BITS = HEADER_SIZE * 8
+    # Low 4 bits of the header flags: id of the codec the payload was compressed with (COMPRESSION_CODECS)
+    FLAG_CODEC_MASK = 0x0F
+
+    # Number of pixels extracted per block while decoding (rounded to whole rows)
+    DECODE_BLOCK_PIXELS = 1 << 16
+
+    # Pixels read from the top of the image when auto-detecting the strength of a legacy watermark
+    PROBE_PIXELS = 1 << 14
+    # Known starts of legacy payloads written by /watermark (JSON metadata), used as signatures
+    LEGACY_SIGNATURES = (b'{"watermark_type"',)
+
+    def __init__(self, strength=3, format_version=FORMAT_V2, compression="none", key=None, threads=1):
         """
         Initialize LSB handler.
         Args:
             strength (int): Encoding strength (1-5). Higher uses more LSB bits.
+            format_version (int): Payload format written by encode_image. FORMAT_V2 (default) writes a
+                length-prefixed header; FORMAT_LEGACY writes the delimiter-terminated format.
+            compression (str): Codec encode_image compresses payloads with: 'none' (default), a name
+                from COMPRESSION_CODECS, or 'auto' for whichever gives the smallest payload. The codec
+                is recorded in the v2 header, so decoding needs no setting. Requires FORMAT_V2.
+            key (str | bytes, optional): Secret key. When set, the header and payload are scattered over
+                the whole image in a keyed pseudo-random pixel order instead of filling it from the
+                top-left, and the same key is needed to find them again. Requires FORMAT_V2.
+            threads (int): Threads that encode and decode one image, each working on a band of rows. Default 1.
         """
+        if format_version not in (self.FORMAT_LEGACY, self.FORMAT_V2):
+            raise ValueError(f"Unsupported payload format version: {format_version}")
+        if compression != "auto" and compression not in available_codecs():
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression != "none" and format_version != self.FORMAT_V2:
+            raise ValueError("Payload compression requires the v2 payload format.")
+        if key is not None and format_version != self.FORMAT_V2:
+            raise ValueError("Keyed embedding requires the v2 payload format.")
+        if key is not None and not key:
+            raise ValueError("The embedding key must not be empty.")
+        if threads < 1:
+            raise ValueError(f"Threads must be at least 1, got {threads}")
+        self.strength = strength
+        self.format_version = format_version
+        self.compression = compression
+        self.key = key
+        self.threads = threads
         # Map strength 1-5 to LSB bits 1-8 more granularly
         # Using ceil ensures strength 1 uses at least 1 bit.
         self.bits_to_use = min(8, max(1, math.ceil(strength * 8 / 5)))
@@ -81,20 +670,75 @@ class LSBSteganography:
         """Calculate the maximum number of bytes that can be hidden in a PIL Image."""
         if not isinstance(image, Image.Image):
              raise TypeError("Input must be a Pillow Image object.")
-        width, height = image.size
+        return self.max_bytes_for_size(*image.size)
+
+    def max_bytes_for_size(self, width, height):
+        """Maximum number of payload bytes an image of this size can hide; needs no pixel data."""
         # Assuming RGBA conversion happens before calling this
         channels = 4
         available_bits = width * height * channels * self.bits_to_use
-        # Subtract bits needed for delimiter
-        if available_bits <= self.DELIMITER_LEN_BITS:
+        # Subtract bits needed for the header (v2) or delimiter (legacy)
+        overhead_bits = self.HEADER_LEN_BITS if self.format_version == self.FORMAT_V2 else self.DELIMITER_LEN_BITS
+        if available_bits <= overhead_bits:
              return 0
-        max_bits = available_bits - self.DELIMITER_LEN_BITS
+        max_bits = available_bits - overhead_bits
         return max_bits // 8 # Convert bits to bytes
 
+    def _build_header(self, data, codec="none"):
+        """Builds the fixed-size v2 header describing the stored (possibly compressed) `data`."""
+        return self.HEADER_STRUCT.pack(self.HEADER_MAGIC, self.FORMAT_V2, self.strength, COMPRESSION_CODECS[codec],
+                                       len(data), zlib.crc32(data))
+
+    def _compress(self, data):
+        """
+        Applies the configured compression to a payload.
+
+        Returns:
+            tuple: (codec name, bytes to store)
+        """
+        if self.compression == "auto":
+            return compress_smallest(data)
+        return self.compression, compress_bytes(data, self.compression)
+
+    def prepare(self, data_to_hide):
+        """
+        Prepares `data_to_hide` for embedding with this handler's settings.
+
+        Compression, the header and the bit groups are computed once here; the returned plan
+        can then be applied to any number of images.
+
+        Args:
+            data_to_hide (bytes): The raw bytes of the data to hide.
+
+        Returns:
+            EmbeddingPlan: The prepared payload.
+
+        Raises:
+            TypeError: If data is not bytes.
+        """
+        if not isinstance(data_to_hide, bytes):
+             raise TypeError("Input 'data_to_hide' must be bytes.")
+
+        codec = "none"
+        if self.compression != "none":
+            codec, data_to_hide = self._compress(data_to_hide) # Capacity applies to the stored bytes
+
+        if self.format_version == self.FORMAT_V2:
+            stream = self._build_header(data_to_hide, codec) + data_to_hide
+        else:
+            stream = data_to_hide + self.DELIMITER
+
+        # One value of bits_to_use bits per channel value, the last one zero-padded
+        group_values = pack_bit_groups(stream, self.bits_to_use)
+        group_values.flags.writeable = False # Plans may be shared between threads
+        return EmbeddingPlan(self, group_values, len(data_to_hide), codec)
+
     def encode_image(self, image, data_to_hide):
         """
         Encodes data (bytes) into a PIL Image object using LSB.
 
+        To hide the same data in many images, prepare() it once and apply the plan to each image.
+
         Args:
             image (Image.Image): Input PIL Image object.
             data_to_hide (bytes): The raw bytes of the data to hide.
@@ -108,107 +752,314 @@ class LSBSteganography:
         """
         if not isinstance(image, Image.Image):
             raise TypeError("Input 'image' must be a Pillow Image object.")
-        if not isinstance(data_to_hide, bytes):
-             raise TypeError("Input 'data_to_hide' must be bytes.")
-
-        img_rgba = image.convert("RGBA") # Ensure RGBA for 4 channels
-        max_bytes = self._get_max_bytes(img_rgba)
-
-        if len(data_to_hide) > max_bytes:
-            raise ValueError(f"Data too large ({len(data_to_hide)} bytes) to hide. Max capacity: {max_bytes} bytes (using {self.bits_to_use} LSB bits).")
-
-        binary_data_to_hide = to_binary(data_to_hide) + self.DELIMITER_BIN
-        data_index = 0
-        n_bits_total = len(binary_data_to_hide)
-
-        # Use image.load() for efficient pixel access
-        pixels = img_rgba.load()
-        width, height = img_rgba.size
-
-        encoded_image = img_rgba.copy() # Work on a copy
-        encoded_pixels = encoded_image.load()
+        return self.prepare(data_to_hide).apply(image)
 
-        # print(f"Encoding {len(data_to_hide)} bytes ({n_bits_total} bits including delimiter)...")
+    def _channels_to_bits(self, channel_values):
+        """Splits an array of channel values into their LSB bits (MSB first), as a flat 0/1 array."""
+        return bit_groups_to_bits(channel_values & self.write_mask, self.bits_to_use)
 
-        for y in range(height):
-            for x in range(width):
-                if data_index >= n_bits_total:
-                     # print(f"Finished encoding after {y*width + x} pixels.")
-                     return encoded_image # All data encoded
+    def _channels_to_bytes(self, channel_values):
+        """Packs the LSBs of an array of channel values into bytes, dropping bits that do not fill a whole byte."""
+        return unpack_bit_groups(channel_values, self.bits_to_use)
 
-                pixel = list(pixels[x, y]) # Get original pixel as list [R, G, B, A]
+    def _keyed_channel_positions(self, width, height, n_channels):
+        """Flat RGBA channel indices of the first `n_channels` channel values in the keyed pixel order."""
+        n_channels = min(n_channels, width * height * 4)
+        pixels = keyed_pixel_order(self.key, width * height)[:-(-n_channels // 4)].astype(np.intp)
+        return (pixels[:, None] * 4 + np.arange(4)).reshape(-1)[:n_channels]
 
-                for channel_index in range(4): # R, G, B, A
-                    if data_index < n_bits_total:
-                        # Get the next bits_to_use bits
-                        start = data_index
-                        end = min(data_index + self.bits_to_use, n_bits_total)
-                        bits_to_encode = binary_data_to_hide[start:end]
+    def _read_leading_bytes(self, image, n_bytes, channels=None):
+        """
+        Reads the first `n_bytes` hidden bytes, converting only the rows that hold them.
 
-                        # Pad with zeros if needed for the last group
-                        bits_to_encode = bits_to_encode.ljust(self.bits_to_use, '0')
+        With a key the bytes are scattered over the whole image, which is converted in full
+        unless its flat RGBA `channels` array is passed in (to share one conversion between reads).
 
-                        # Convert to decimal
-                        bits_value = int(bits_to_encode, 2)
+        Returns:
+            bytes: The bytes read, or fewer if the image is too small to hold `n_bytes`.
+        """
+        width, height = image.size
+        n_channels = -(-n_bytes * 8 // self.bits_to_use)
+        positions = None
+        if self.key is not None:
+            if channels is None:
+                channels = _rgba_channels(image, threads=self.threads)
+            positions = self._keyed_channel_positions(width, height, n_channels)
+        else:
+            channels = _rgba_channels(image, -(-n_channels // (width * 4)), self.threads)
+        n_channels = min(n_channels, channels.size)
+
+        def unpack_range(start, stop):
+            channel_values = channels[positions[start:stop]] if positions is not None else channels[start:stop]
+            return self._channels_to_bytes(channel_values)
+        # Every 8 channel values hold whole bytes, so ranges of multiples of 8 unpack independently
+        ranges = _split_ranges(n_channels, STRIP_PIXELS * 4, self.threads, multiple=8, min_size=1 << 16)
+        return b"".join(_map_ranges(unpack_range, ranges, self.threads))[:n_bytes]
+
+    @classmethod
+    def detect_strength(cls, image, key=None, threads=1):
+        """
+        Detects the strength a watermark was encoded with by probing every bit depth on the leading pixels.
 
-                        # Clear the LSBs and set new ones
-                        pixel[channel_index] = (pixel[channel_index] & self.clear_mask) | bits_value
+        The leading pixels are converted once; each strength then checks them for the v2 header
+        signature, a known legacy payload signature, or the legacy delimiter.
 
-                        data_index = end # Move to next group of bits
+        Args:
+            image (Image.Image): The encoded PIL Image object.
+            key (str | bytes, optional): Key of a keyed watermark; its header is probed in the keyed pixel order.
+            threads (int): Threads converting the image when probing for a keyed watermark.
 
-                encoded_pixels[x, y] = tuple(pixel) # Update pixel in the copied image
+        Returns:
+            int: The detected strength (1-5), or None if no watermark was recognized.
+        """
+        if not isinstance(image, Image.Image):
+            raise TypeError("Input must be a Pillow Image object.")
+        width, height = image.size
+        if width == 0 or height == 0:
+            return None
+
+        if key is not None:
+            channels = _rgba_channels(image, threads=threads) # Converted once for all strengths
+            for strength in range(1, 6):
+                probe_bytes = cls(strength, key=key)._read_leading_bytes(image, cls.HEADER_SIZE, channels)
+                if probe_bytes.startswith(cls.HEADER_MAGIC) and len(probe_bytes) == cls.HEADER_SIZE:
+                    if cls.HEADER_STRUCT.unpack_from(probe_bytes)[2] == strength:
+                        return strength
+            return None
+
+        n_rows = min(height, -(-cls.PROBE_PIXELS // width))
+        leading_channels = np.asarray(image.crop((0, 0, width, n_rows)).convert("RGBA")).reshape(-1)
+        probes = {strength: cls(strength)._channels_to_bytes(leading_channels) for strength in range(1, 6)}
+
+        # v2 header: magic plus a strength byte that agrees with the probed depth
+        for strength, probe_bytes in probes.items():
+            if probe_bytes.startswith(cls.HEADER_MAGIC) and len(probe_bytes) >= cls.HEADER_SIZE:
+                if cls.HEADER_STRUCT.unpack_from(probe_bytes)[2] == strength:
+                    return strength
+        # Legacy payloads: a known payload prefix, or a delimiter within the probed pixels
+        for strength, probe_bytes in probes.items():
+            if probe_bytes.startswith(cls.LEGACY_SIGNATURES) or cls.DELIMITER in probe_bytes:
+                return strength
+        return None
+
+    def _read_header(self, image, channels=None):
+        """
+        Reads and validates the v2 header at the start of the image (or of the keyed pixel order).
 
-        # If loop finishes, check if all data was encoded (should be caught earlier by size check)
-        if data_index < n_bits_total:
-            raise RuntimeError(f"Could not encode all data despite size check. Encoded {data_index}/{n_bits_total} bits. This indicates a bug.")
+        Returns:
+            tuple: (version, strength, flags, payload_length, checksum), or None if no v2 header is present.
 
-        return encoded_image # Should have returned earlier if successful
+        Raises:
+            ValueError: If a header is present but inconsistent with this handler or the image size.
+        """
+        header_bytes = self._read_leading_bytes(image, self.HEADER_SIZE, channels)
+        if len(header_bytes) < self.HEADER_SIZE or not header_bytes.startswith(self.HEADER_MAGIC):
+            return None
+
+        magic, version, strength, flags, payload_length, checksum = self.HEADER_STRUCT.unpack(header_bytes)
+        if version != self.FORMAT_V2:
+            raise ValueError(f"Unsupported watermark format version {version}.")
+        if strength != self.strength:
+            raise ValueError(f"Watermark header reports strength {strength}, but strength {self.strength} was used for decoding.")
+        if (flags & ~self.FLAG_CODEC_MASK) or (flags & self.FLAG_CODEC_MASK) not in COMPRESSION_CODECS.values():
+            raise ValueError(f"Watermark header has unsupported flags {flags:#04x}. It may need a newer version of StegaMark.")
+        width, height = image.size
+        if payload_length > (width * height * 4 * self.bits_to_use - self.HEADER_LEN_BITS) // 8:
+            raise ValueError(f"Watermark header reports {payload_length} bytes, which exceeds the image capacity. The image may be corrupted.")
+        return version, strength, flags, payload_length, checksum
 
-    def decode_image(self, image):
+    def decode_image(self, image, allow_legacy=True):
         """
         Decodes hidden data from a PIL Image object using LSB.
 
+        v2 images are decoded by reading the fixed-size header and then exactly the pixels
+        holding the payload. Images without a header fall back to the legacy delimiter scan.
+
         Args:
             image (Image.Image): The encoded PIL Image object.
+            allow_legacy (bool): Fall back to scanning for the legacy delimiter when no v2 header
+                is found. If False, images without a header are rejected after reading the header pixels.
 
         Returns:
-            bytes: The extracted data if found.
+            bytes: The extracted data if found, decompressed if it was stored compressed.
 
         Raises:
-            ValueError: If no hidden data (delimiter) is found.
+            ValueError: If no hidden data (header or delimiter) is found, or the payload is corrupted.
             TypeError: If input is not a PIL Image.
         """
         if not isinstance(image, Image.Image):
             raise TypeError("Input must be a Pillow Image object.")
 
-        img_rgba = image.convert("RGBA")
-        pixels = img_rgba.load()
-        width, height = img_rgba.size
-        binary_result = ""
-
-        # print(f"Decoding using {self.bits_to_use} LSB bits...")
-
-        # Iterate through pixels and channels to extract LSBs
-        for y in range(height):
-            for x in range(width):
-                pixel = pixels[x, y]
-                for channel_value in pixel: # R, G, B, A
-                    # Extract the specified number of LSB bits
-                    lsb_bits = channel_value & self.write_mask # Use write_mask to get only LSBs
-                    binary_result += format(lsb_bits, f'0{self.bits_to_use}b')
-
-                    # Check frequently if the delimiter suffix is found (more efficient than searching full string)
-                    if len(binary_result) >= self.DELIMITER_LEN_BITS and binary_result.endswith(self.DELIMITER_BIN):
-                        # Found delimiter, extract data up to this point
-                        # print(f"Delimiter found after extracting approx {len(binary_result)} bits.")
-                        data_part = binary_result[:-self.DELIMITER_LEN_BITS]
-                        return binary_to_bytes(data_part)
+        width, height = image.size
+        if width == 0 or height == 0:
+            raise ValueError("Image is empty. No hidden data detected.")
+
+        # Keyed watermarks are spread over the whole image: convert it once for the header and payload reads
+        channels = _rgba_channels(image, threads=self.threads) if self.key is not None else None
+        header = self._read_header(image, channels)
+        if header is not None:
+            _, _, flags, payload_length, checksum = header
+            stream = self._read_leading_bytes(image, self.HEADER_SIZE + payload_length, channels)
+            data = stream[self.HEADER_SIZE:]
+            if zlib.crc32(data) != checksum:
+                raise ValueError("Watermark checksum mismatch. The image was modified after encoding.")
+            codec = {value: name for name, value in COMPRESSION_CODECS.items()}[flags & self.FLAG_CODEC_MASK]
+            return decompress_bytes(data, codec)
+
+        if self.key is not None:
+            raise ValueError(f"No watermark header found for this key. No hidden data detected, or incorrect key or strength used (Expected strength corresponding to {self.bits_to_use} bits).")
+        if not allow_legacy:
+            raise ValueError(f"No watermark header found. No hidden data detected or incorrect strength used (Expected strength corresponding to {self.bits_to_use} bits).")
+        return self._decode_legacy(image)
+
+    def _decode_legacy(self, image):
+        """Decodes the delimiter-terminated (v1) format by scanning the image in row blocks."""
+        width, height = image.size
+        rows_per_block = max(1, self.DECODE_BLOCK_PIXELS // width)
+
+        extracted = bytearray()               # Packed bytes recovered so far
+        leftover_bits = np.empty(0, np.uint8) # Bits that did not fill a whole byte yet
+        search_from = 0                       # Bytes before this offset were already searched
+
+        # Extract LSBs in row blocks so a small watermark is found without converting the rest of the image
+        for y in range(0, height, rows_per_block):
+            block_rgba = image.crop((0, y, width, min(height, y + rows_per_block))).convert("RGBA")
+            block_bits = self._channels_to_bits(np.asarray(block_rgba).reshape(-1))
+            if leftover_bits.size:
+                block_bits = np.concatenate((leftover_bits, block_bits))
+
+            n_whole_bits = block_bits.size - block_bits.size % 8
+            extracted += np.packbits(block_bits[:n_whole_bits]).tobytes()
+            leftover_bits = block_bits[n_whole_bits:]
+
+            delimiter_index = extracted.find(self.DELIMITER, search_from)
+            if delimiter_index != -1:
+                # Found delimiter, extract data up to this point
+                return bytes(extracted[:delimiter_index])
+            # Keep an overlap so a delimiter split across two blocks is still found
+            search_from = max(0, len(extracted) - len(self.DELIMITER) + 1)
 
         # If we've searched the entire image and not found the delimiter
         raise ValueError(f"Delimiter not found in image. No hidden data detected or incorrect strength used (Expected strength corresponding to {self.bits_to_use} bits).")
 
+class EmbeddingPlan:
+    """
+    A payload prepared by LSBSteganography.prepare: the value to write into each channel's LSBs.
+
+    Applying a plan repeats none of the payload preparation (compression, header, bit grouping),
+    so one plan marks a whole catalog of images with a mask-and-OR per image. Plans are not
+    modified by apply() and can be shared between threads and pickled to worker processes.
+    """
+
+    def __init__(self, steg, group_values, stored_length, codec):
+        """
+        Args:
+            steg (LSBSteganography): The handler whose settings (strength, format, key) the plan was built with.
+            group_values (np.ndarray): uint8 values for the LSBs of consecutive channel values.
+            stored_length (int): Payload bytes as stored, i.e. after compression.
+            codec (str): Compression codec applied to the payload.
+        """
+        self.steg = steg
+        self.group_values = group_values
+        self.stored_length = stored_length
+        self.codec = codec
+
+    def apply(self, image, threads=None):
+        """
+        Embeds the planned payload into an image.
+
+        Args:
+            image (Image.Image): Input PIL Image object.
+            threads (int, optional): Threads that process bands of the image; defaults to the handler's.
+
+        Returns:
+            Image.Image: The encoded PIL Image object (always RGBA).
+
+        Raises:
+            ValueError: If the payload is too large for the image.
+            TypeError: If input is not a PIL Image.
+        """
+        steg = self.steg
+        threads = threads or steg.threads
+        max_bytes = steg._get_max_bytes(image)
+        if self.stored_length > max_bytes:
+            compressed_note = f" after {self.codec} compression" if self.codec != "none" else ""
+            raise ValueError(f"Data too large ({self.stored_length} bytes{compressed_note}) to hide. Max capacity: {max_bytes} bytes (using {steg.bits_to_use} LSB bits).")
+
+        group_values = self.group_values
+        n_groups = group_values.size
+        width, height = image.size
+        if n_groups > width * height * 4:
+            raise RuntimeError(f"Could not encode all data despite size check. Needed {n_groups} channel values, image has {width * height * 4}. This indicates a bug.")
+
+        if steg.key is not None:
+            # Keyed order: the groups land on scattered pixels all over the image, so work on the whole array
+            channels = _rgba_channels(image, threads=threads)
+            if not channels.flags.writeable:
+                channels = channels.copy()
+            positions = steg._keyed_channel_positions(width, height, n_groups)
+            def embed_range(start, stop):
+                range_positions = positions[start:stop]
+                channels[range_positions] = (channels[range_positions] & steg.clear_mask) | group_values[start:stop]
+            for _ in _map_ranges(embed_range, _split_ranges(n_groups, STRIP_PIXELS * 4, threads, min_size=1 << 16), threads):
+                pass
+            return Image.fromarray(channels.reshape(height, width, 4))
+
+        encoded_image = image.convert("RGBA") # Ensure RGBA for 4 channels; this is also the output copy
+
+        # One group per channel value, walking R, G, B, A of each pixel in row-major order.
+        # Only the bands holding the payload are touched, one band array at a time per thread.
+        rows_with_data = -(-n_groups // (width * 4))
+        def embed_band(y0, y1):
+            band_array = np.array(encoded_image.crop((0, y0, width, y1)), dtype=np.uint8) # (rows, W, 4)
+            flat_channels = band_array.reshape(-1)
+            band_groups = group_values[y0 * width * 4:y1 * width * 4]
+            n_band = band_groups.size
+
+            # Clear the LSBs and set new ones, for all affected channels of the band at once
+            flat_channels[:n_band] = (flat_channels[:n_band] & steg.clear_mask) | band_groups
+            return Image.fromarray(band_array)
+
+        bands = _split_ranges(rows_with_data, _band_rows(width), threads)
+        for (y0, _), band_image in zip(bands, _map_ranges(embed_band, bands, threads)):
+            encoded_image.paste(band_image, (0, y0)) # Pasted in order by this thread only
+        return encoded_image
+
+def capacity_report(width, height, payload=None, compression="auto"):
+    """
+    Reports how many payload bytes an image of the given size can hide at every strength.
+
+    Args:
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        payload (bytes, optional): A payload to check against each capacity, both as-is and compressed.
+        compression (str): Codec used for the compressed figures: a name from COMPRESSION_CODECS or 'auto'.
+
+    Returns:
+        dict: {"width", "height", "capacity": [{"strength", "lsb_bits", "max_bytes"[, "fits", "fits_compressed"]}, ...]}
+              plus {"payload": {"bytes", "compressed_bytes", "codec"}} when a payload is given.
+    """
+    report = {"width": width, "height": height, "capacity": []}
+    if payload is not None:
+        codec, stored = compress_smallest(payload) if compression == "auto" else (compression, compress_bytes(payload, compression))
+        report["payload"] = {"bytes": len(payload), "compressed_bytes": len(stored), "codec": codec}
+    for strength in range(1, 6):
+        steg = LSBSteganography(strength)
+        entry = {"strength": strength, "lsb_bits": steg.bits_to_use, "max_bytes": steg.max_bytes_for_size(width, height)}
+        if payload is not None:
+            entry["fits"] = len(payload) <= entry["max_bytes"]
+            entry["fits_compressed"] = len(stored) <= entry["max_bytes"]
+        report["capacity"].append(entry)
+    return report
+
 # --- Visible Watermarking Core ---
 
+# Rendered watermark elements (text sprites, scaled/rotated logos), shared by all requests.
+# Bounded by entries and by the bytes of the RGBA sprites, since clients control their size.
+element_cache = LRUCache(maxsize=int(os.environ.get('STEGAMARK_ELEMENT_CACHE_SIZE', 256)),
+                         maxbytes=int(os.environ.get('STEGAMARK_ELEMENT_CACHE_BYTES', 128 * 1024 * 1024)),
+                         sizeof=lambda element: element.width * element.height * 4)
+
 def _calculate_position(img_width, img_height, wm_width, wm_height, position_keyword, padding=10):
     """Calculates (x, y) coordinates based on keywords."""
     if position_keyword == "top-left":
@@ -247,70 +1098,89 @@ def _calculate_position(img_width, img_height, wm_width, wm_height, position_key
     y = max(0, min(y, img_height - wm_height))
     return int(x), int(y)
 
-def add_visible_watermark(image, text=None, logo_image=None, position="center", opacity=0.5,
-                          font_path=None, font_size=None, text_color=(255, 255, 255), logo_scale=0.15,
-                          tile_style="none", tile_spacing=0.1, tile_angle=45): # Added tile_style, tile_spacing, tile_angle
+def _build_tile_cell(wm_img, step_x, step_y, stagger=False):
     """
-    Adds a visible text or logo watermark to a PIL Image object. Can tile the watermark with various styles.
+    Renders the repeat cell of a tiled watermark layer, aligned to canvas (0, 0).
+
+    Tiling the cell reproduces pasting `wm_img` every (step_x, step_y) starting at
+    (-wm_width, -wm_height), with odd rows shifted left by step_x // 2 when `stagger` is set.
+    Requires non-overlapping tiles (step >= watermark size).
 
     Args:
-        image (Image.Image): Base image.
-        text (str, optional): Text for the watermark. Defaults to None.
-        logo_image (Image.Image, optional): Logo image for the watermark. Defaults to None.
-        position (str, optional): Position keyword. Used only if tile_style='none'. Defaults to "center".
-        opacity (float, optional): Opacity from 0.0 (transparent) to 1.0 (opaque). Defaults to 0.5.
-        font_path (str, optional): Path to a .ttf font file for text. Defaults to None (uses PIL default).
-        font_size (int, optional): Font size for text. Calculated if None. Defaults to None.
-        text_color (tuple, optional): RGB color for text (0-255). Defaults to (255, 255, 255).
-        logo_scale (float, optional): Scale factor for logo based on base image width. Defaults to 0.15.
-        tile_style (str, optional): Tiling style ('none', 'grid', 'staggered', 'diagonal'). Defaults to "none".
-        tile_spacing (float, optional): Spacing between tiles as a fraction of watermark dimension (width/height). Defaults to 0.1.
-        tile_angle (int, optional): Angle (degrees) to rotate the watermark element for 'diagonal' style. Defaults to 45.
+        wm_img (Image.Image): RGBA watermark element, pasted with its own alpha as mask.
+        step_x (int): Horizontal distance between tile origins.
+        step_y (int): Vertical distance between tile origins.
+        stagger (bool): Offset alternate rows by half a step.
 
     Returns:
-        Image.Image: Image with watermark applied.
+        np.ndarray: (cell height, step_x, 4) uint8 RGBA array.
+    """
+    wm_width, wm_height = wm_img.size
+    cell_height = step_y * 2 if stagger else step_y
+
+    # One repeat cell, with the cell origin at the first tile position (-wm_width, -wm_height)
+    cell = Image.new("RGBA", (step_x, cell_height), (255, 255, 255, 0))
+    cell.paste(wm_img, (0, 0), wm_img)
+    if stagger:
+        offset = step_x // 2
+        cell.paste(wm_img, (-offset, step_y), wm_img)
+        if offset:
+            cell.paste(wm_img, (step_x - offset, step_y), wm_img) # Part that wraps around the cell edge
+
+    # Shift the cell so it lines up with canvas (0, 0)
+    return np.roll(np.asarray(cell), (-(wm_height % cell_height), -(wm_width % step_x)), axis=(0, 1))
+
+def _tiled_layer_band(tile_cell, width, y0, y1):
+    """Returns rows y0..y1 of the tiled watermark layer built from `tile_cell`, as an RGBA image."""
+    cell_height, cell_width = tile_cell.shape[:2]
+    band_rows = tile_cell[np.arange(y0, y1) % cell_height]
+    band_array = np.tile(band_rows, (1, -(-width // cell_width), 1))[:, :width]
+    return Image.fromarray(np.ascontiguousarray(band_array))
+
+def _load_font(font_path, font_size):
+    """Loads a TrueType font, falling back to PIL's default font."""
+    try:
+        # Load font (simplified fallback logic)
+        try: return ImageFont.truetype(font_path or "arial.ttf", font_size)
+        except IOError: return ImageFont.load_default()
+    except Exception as e:
+        print(f"Warning: Font loading error ({e}). Using default font.", file=sys.stderr)
+        return ImageFont.load_default()
 
-    Raises:
-        ValueError: If neither text nor logo is provided, or logo_image is not a PIL Image.
-        TypeError: If base image is not a PIL Image.
+def _render_watermark_element(text=None, logo_image=None, opacity=0.5, font_path=None, font_size=10,
+                              text_color=(255, 255, 255), logo_width=0, rotation=0):
     """
-    if not isinstance(image, Image.Image):
-        raise TypeError("Base image must be a Pillow Image object.")
-    if text is None and logo_image is None:
-        raise ValueError("Either text or logo_image must be provided for visible watermark.")
-    if logo_image is not None and not isinstance(logo_image, Image.Image):
-         raise TypeError("logo_image must be a Pillow Image object.")
+    Renders the watermark element (text or logo) onto its own transparent RGBA image.
 
-    base_image = image.convert("RGBA")
-    width, height = base_image.size
-    watermark_layer = Image.new("RGBA", base_image.size, (255, 255, 255, 0)) # Main transparent layer
+    Args:
+        text (str, optional): Text to render. Takes precedence over logo_image.
+        logo_image (Image.Image, optional): Logo to scale to `logo_width` pixels wide.
+        opacity (float): Opacity from 0.0 to 1.0.
+        font_path (str, optional): Path to a .ttf font file for text.
+        font_size (int): Font size for text.
+        text_color (tuple): RGB color for text.
+        logo_width (int): Target logo width in pixels.
+        rotation (int): Angle (degrees) to rotate the element by, 0 for none.
 
+    Returns:
+        Image.Image: The ready-to-paste element, or None if it could not be prepared.
+    """
     alpha = int(opacity * 255) # Convert opacity float (0-1) to int (0-255)
 
-    # --- Prepare the base watermark element (text or logo) onto its own transparent image ---
     wm_element_img = None
     original_wm_width, original_wm_height = 0, 0
     bbox = [0, 0, 0, 0] # To handle text positioning
 
     if text:
-        if font_size is None: font_size = max(10, int(height * 0.05))
-        try:
-            # Load font (simplified fallback logic)
-            try: font = ImageFont.truetype(font_path or "arial.ttf", font_size)
-            except IOError: font = ImageFont.load_default()
-        except Exception as e:
-            print(f"Warning: Font loading error ({e}). Using default font.", file=sys.stderr)
-            font = ImageFont.load_default()
+        font = _load_font(font_path, font_size)
 
         # Get text dimensions accurately using textbbox
+        temp_draw = ImageDraw.Draw(Image.new("RGBA", (1,1)))
         try:
-            temp_draw = ImageDraw.Draw(Image.new("RGBA", (1,1)))
             bbox = temp_draw.textbbox((0, 0), text, font=font) # (left, top, right, bottom)
             original_wm_width = bbox[2] - bbox[0]
             original_wm_height = bbox[3] - bbox[1]
         except AttributeError: # Fallback for older PIL / default font
-             # Use the main layer's draw temporarily for measurement
-             temp_draw = ImageDraw.Draw(watermark_layer)
              text_length = temp_draw.textlength(text, font=font)
              original_wm_width = int(text_length)
              original_wm_height = int(font_size * 1.2) # Crude estimate
@@ -318,7 +1188,7 @@ def add_visible_watermark(image, text=None, logo_image=None, position="center",
 
         if original_wm_width <= 0 or original_wm_height <= 0:
              print(f"Warning: Calculated text dimensions invalid ({original_wm_width}x{original_wm_height}). Skipping.", file=sys.stderr)
-             return image.convert("RGB")
+             return None
 
         # Create a correctly sized transparent image for the text
         text_img = Image.new('RGBA', (original_wm_width, original_wm_height), (255, 255, 255, 0))
@@ -329,7 +1199,7 @@ def add_visible_watermark(image, text=None, logo_image=None, position="center",
 
     elif logo_image:
         logo = logo_image.convert("RGBA")
-        base_width = int(width * logo_scale)
+        base_width = logo_width
         if logo.size[0] > 0:
             w_percent = (base_width / float(logo.size[0]))
             h_size = int((float(logo.size[1]) * float(w_percent))) if logo.size[1] > 0 and w_percent > 0 else 0
@@ -337,7 +1207,7 @@ def add_visible_watermark(image, text=None, logo_image=None, position="center",
 
         if base_width <= 0 or h_size <= 0:
              print(f"Warning: Calculated logo size invalid ({base_width}x{h_size}). Skipping.", file=sys.stderr)
-             return image.convert("RGB")
+             return None
 
         logo = logo.resize((base_width, h_size), Image.Resampling.LANCZOS)
         original_wm_width, original_wm_height = logo.size
@@ -354,14 +1224,14 @@ def add_visible_watermark(image, text=None, logo_image=None, position="center",
 
     if not wm_element_img or original_wm_width <= 0 or original_wm_height <= 0:
         print("Warning: Watermark element could not be prepared. Returning original.", file=sys.stderr)
-        return image.convert("RGB")
+        return None
 
     # --- Handle Rotation for Diagonal Style ---
     rotated_wm_img = wm_element_img
-    if tile_style == "diagonal" and tile_angle != 0:
+    if rotation:
         try:
             # Rotate the element image, expanding the canvas to fit, use transparent fill
-            rotated_wm_img = wm_element_img.rotate(tile_angle, resample=Image.Resampling.BICUBIC, expand=True)
+            rotated_wm_img = wm_element_img.rotate(rotation, resample=Image.Resampling.BICUBIC, expand=True)
             # The background created by rotate might not be fully transparent, ensure it is
             # This is tricky, might need a mask - let's assume rotate handles transparency well enough for now
             # or paste the rotated image onto a new transparent background of the same expanded size.
@@ -369,65 +1239,241 @@ def add_visible_watermark(image, text=None, logo_image=None, position="center",
             print(f"Warning: Could not rotate watermark element: {e}. Using unrotated.", file=sys.stderr)
             rotated_wm_img = wm_element_img # Fallback to unrotated
 
-    # Use dimensions of the (potentially rotated) element for tiling calculations
-    wm_width, wm_height = rotated_wm_img.size
-    if wm_width <= 0 or wm_height <= 0:
-        print(f"Warning: Watermark dimensions invalid after potential rotation ({wm_width}x{wm_height}). Skipping.", file=sys.stderr)
-        return image.convert("RGB")
-
+    return rotated_wm_img
 
-    # --- Apply Watermark (Single or Tiled) ---
-    if tile_style == "none":
-        # Place single watermark using the potentially rotated element
-        pos_x, pos_y = _calculate_position(width, height, wm_width, wm_height, position)
-        # Paste using the element's alpha channel as the mask
-        watermark_layer.paste(rotated_wm_img, (pos_x, pos_y), rotated_wm_img)
-    else:
-        # --- Tiling Logic ---
-        # Calculate spacing in pixels based on the potentially rotated dimensions
-        spacing_x = int(wm_width * tile_spacing)
-        spacing_y = int(wm_height * tile_spacing)
-        step_x = wm_width + spacing_x
-        step_y = wm_height + spacing_y
+def _logo_digest(logo_image):
+    """Hex digest identifying a logo by its mode, size and pixel content."""
+    logo_hash = hashlib.sha1(f"{logo_image.mode}:{logo_image.size}:".encode('ascii'))
+    logo_hash.update(logo_image.tobytes())
+    if logo_image.palette is not None: # Same indices with a different palette are a different logo
+        logo_hash.update(bytes(logo_image.getpalette() or []))
+    return logo_hash.hexdigest()
 
-        if step_x <= 0 or step_y <= 0: # Prevent infinite loop / division by zero
-             print("Warning: Invalid tile step size (<= 0). Applying single watermark instead.", file=sys.stderr)
-             pos_x, pos_y = _calculate_position(width, height, wm_width, wm_height, position)
-             watermark_layer.paste(rotated_wm_img, (pos_x, pos_y), rotated_wm_img)
-        else:
-            # Calculate starting points to ensure coverage even with rotation/staggering
-            # These are approximate starting points off-canvas
-            start_y = -wm_height # Start further up
-            start_x = -wm_width  # Start further left
+def _get_watermark_element(text=None, logo_image=None, opacity=0.5, font_path=None, font_size=10,
+                           text_color=(255, 255, 255), logo_width=0, rotation=0):
+    """
+    Returns the rendered watermark element from `element_cache`, rendering it on a miss.
 
-            row_count = 0
-            # Loop well beyond the bottom edge
-            for y in range(start_y, height + wm_height, step_y):
-                 current_start_x = start_x
-                 # Apply stagger offset for 'staggered' and 'diagonal' styles
-                 if tile_style == "staggered" or tile_style == "diagonal":
-                     if row_count % 2 != 0:
-                         current_start_x -= (step_x // 2) # Offset alternate rows leftwards
+    Takes the same arguments as _render_watermark_element. Logos are keyed by a hash of
+    their pixel content. The returned image is shared and must not be modified.
+    """
+    if text:
+        key = ("text", text, font_path, font_size, tuple(text_color), opacity, rotation)
+    elif logo_image is None:
+        return _render_watermark_element(text=text, opacity=opacity) # Nothing to render; logs a warning
+    else:
+        key = ("logo", _logo_digest(logo_image), logo_width, opacity, rotation)
 
-                 # Loop well beyond the right edge
-                 for x in range(current_start_x, width + wm_width, step_x):
-                     pos_x = x
-                     pos_y = y
-                     # Paste the (potentially rotated) watermark element image
-                     # Use the element's alpha channel as the mask for proper transparency
-                     watermark_layer.paste(rotated_wm_img, (pos_x, pos_y), rotated_wm_img)
-                 row_count += 1
+    element = element_cache.get(key)
+    if element is None:
+        element = _render_watermark_element(text=text, logo_image=logo_image, opacity=opacity,
+                                            font_path=font_path, font_size=font_size, text_color=text_color,
+                                            logo_width=logo_width, rotation=rotation)
+        if element is not None:
+            element_cache.put(key, element)
+    return element
 
-    # Composite the watermark layer onto the base image
-    watermarked_image = Image.alpha_composite(base_image, watermark_layer)
-    # Return RGB. If original was PNG and transparency is desired, more complex handling needed.
-    return watermarked_image.convert("RGB")
+def add_visible_watermark(image, text=None, logo_image=None, position="center", opacity=0.5,
+                          font_path=None, font_size=None, text_color=(255, 255, 255), logo_scale=0.15,
+                          tile_style="none", tile_spacing=0.1, tile_angle=45, threads=1, padding=10): # Added tile_style, tile_spacing, tile_angle
+    """
+    Adds a visible text or logo watermark to a PIL Image object. Can tile the watermark with various styles.
 
-# --- Flask Web Application ---
-app = Flask(__name__, static_folder='.') # Serve static files from root for simplicity
+    Args:
+        image (Image.Image): Base image.
+        text (str, optional): Text for the watermark. Defaults to None.
+        logo_image (Image.Image, optional): Logo image for the watermark. Defaults to None.
+        position (str, optional): Position keyword. Used only if tile_style='none'. Defaults to "center".
+        opacity (float, optional): Opacity from 0.0 (transparent) to 1.0 (opaque). Defaults to 0.5.
+        font_path (str, optional): Path to a .ttf font file for text. Defaults to None (uses PIL default).
+        font_size (int, optional): Font size for text. Calculated if None. Defaults to None.
+        text_color (tuple, optional): RGB color for text (0-255). Defaults to (255, 255, 255).
+        logo_scale (float, optional): Scale factor for logo based on base image width. Defaults to 0.15.
+        tile_style (str, optional): Tiling style ('none', 'grid', 'staggered', 'diagonal'). Defaults to "none".
+        tile_spacing (float, optional): Spacing between tiles as a fraction of watermark dimension (width/height). Defaults to 0.1.
+        tile_angle (int, optional): Angle (degrees) to rotate the watermark element for 'diagonal' style. Defaults to 45.
+        threads (int, optional): Threads compositing bands of the image in parallel. Defaults to 1.
+        padding (int, optional): Distance in pixels from the image edge for positions other than center. Defaults to 10.
+
+    Returns:
+        Image.Image: Image with watermark applied.
+
+    Raises:
+        ValueError: If neither text nor logo is provided, or logo_image is not a PIL Image.
+        TypeError: If base image is not a PIL Image.
+    """
+    if not isinstance(image, Image.Image):
+        raise TypeError("Base image must be a Pillow Image object.")
+    if text is None and logo_image is None:
+        raise ValueError("Either text or logo_image must be provided for visible watermark.")
+    if logo_image is not None and not isinstance(logo_image, Image.Image):
+         raise TypeError("logo_image must be a Pillow Image object.")
+
+    width, height = image.size
+
+    # --- Prepare the (cached) watermark element: text or logo, rotated for the diagonal style ---
+    if text and font_size is None: font_size = max(10, int(height * 0.05))
+    rotation = tile_angle if tile_style == "diagonal" and tile_angle != 0 else 0
+    rotated_wm_img = _get_watermark_element(text=text, logo_image=logo_image, opacity=opacity,
+                                            font_path=font_path, font_size=font_size, text_color=text_color,
+                                            logo_width=int(width * logo_scale), rotation=rotation)
+    if rotated_wm_img is None:
+        return image.convert("RGB")
+
+    # Use dimensions of the (potentially rotated) element for tiling calculations
+    wm_width, wm_height = rotated_wm_img.size
+    if wm_width <= 0 or wm_height <= 0:
+        print(f"Warning: Watermark dimensions invalid after potential rotation ({wm_width}x{wm_height}). Skipping.", file=sys.stderr)
+        return image.convert("RGB")
+
+
+    # --- Plan the Watermark Layer (Single or Tiled) ---
+    tile_cell = None # Repeat cell for non-overlapping tiles
+    placements = []  # Otherwise, positions to paste the element at, in paste order
+    if tile_style == "none":
+        # Place single watermark using the potentially rotated element
+        placements.append(_calculate_position(width, height, wm_width, wm_height, position, padding))
+    else:
+        # --- Tiling Logic ---
+        # Calculate spacing in pixels based on the potentially rotated dimensions
+        spacing_x = int(wm_width * tile_spacing)
+        spacing_y = int(wm_height * tile_spacing)
+        step_x = wm_width + spacing_x
+        step_y = wm_height + spacing_y
+
+        if step_x <= 0 or step_y <= 0: # Prevent infinite loop / division by zero
+             print("Warning: Invalid tile step size (<= 0). Applying single watermark instead.", file=sys.stderr)
+             placements.append(_calculate_position(width, height, wm_width, wm_height, position, padding))
+        elif 0 <= spacing_x and 0 <= spacing_y and step_x <= width + wm_width and step_y <= height + wm_height:
+            # Tiles never overlap, so the layer is periodic: render one repeat cell and tile it
+            # (only while the cell is no larger than the canvas it covers; wider steps mean few tiles)
+            tile_cell = _build_tile_cell(rotated_wm_img, step_x, step_y,
+                                         stagger=tile_style in ("staggered", "diagonal"))
+        else:
+            # Overlapping tiles (negative spacing) blend into each other, and steps wider than the
+            # image leave only a handful of tiles, so paste them one by one
+            # Calculate starting points to ensure coverage even with rotation/staggering
+            # These are approximate starting points off-canvas
+            start_y = -wm_height # Start further up
+            start_x = -wm_width  # Start further left
+
+            row_count = 0
+            # Loop well beyond the bottom edge
+            for y in range(start_y, height + wm_height, step_y):
+                 current_start_x = start_x
+                 # Apply stagger offset for 'staggered' and 'diagonal' styles
+                 if tile_style == "staggered" or tile_style == "diagonal":
+                     if row_count % 2 != 0:
+                         current_start_x -= (step_x // 2) # Offset alternate rows leftwards
+
+                 # Loop well beyond the right edge
+                 for x in range(current_start_x, width + wm_width, step_x):
+                     placements.append((x, y))
+                 row_count += 1
+
+    # --- Composite in Horizontal Bands ---
+    # Only one band of the RGBA base and watermark layer exists at a time (per thread), so peak memory
+    # is the input and output images plus a few bands, instead of several full-size RGBA buffers.
+    def composite_band(y0, y1):
+        if tile_cell is not None:
+            layer_band = _tiled_layer_band(tile_cell, width, y0, y1)
+        else:
+            layer_band = Image.new("RGBA", (width, y1 - y0), (255, 255, 255, 0)) # Transparent layer band
+            for pos_x, pos_y in placements:
+                if pos_y < y1 and pos_y + wm_height > y0:
+                    # Paste using the element's alpha channel as the mask for proper transparency
+                    layer_band.paste(rotated_wm_img, (pos_x, pos_y - y0), rotated_wm_img)
+
+        # Composite the watermark layer band onto the matching band of the base image
+        base_band = image.crop((0, y0, width, y1)).convert("RGBA")
+        # Return RGB. If original was PNG and transparency is desired, more complex handling needed.
+        return Image.alpha_composite(base_band, layer_band).convert("RGB")
+
+    _load_for_threads(image, threads)
+    watermarked_image = Image.new("RGB", (width, height))
+    bands = _split_ranges(height, _band_rows(width), threads)
+    for (y0, _), band_image in zip(bands, _map_ranges(composite_band, bands, threads)):
+        watermarked_image.paste(band_image, (0, y0))
+    return watermarked_image
+
+# --- Output Encoding ---
+
+# Named encoder tradeoffs: Pillow save options per output format, plus the lossless format that
+# invisible (LSB) watermarks are written in. 'balanced' is what the web app has always produced.
+OUTPUT_PROFILES = {
+    "fastest": {
+        "PNG": {"compress_level": 1, "compress_type": zlib.Z_RLE}, # LSB noise defeats LZ77 matches anyway
+        "JPEG": {"quality": 90, "subsampling": 2, "optimize": False}, # 4:2:0
+        "WEBP": {"lossless": True, "exact": True, "method": 0, "quality": 0},
+        "lsb_format": "PNG",
+    },
+    "balanced": {
+        "PNG": {"compress_level": 1},
+        "JPEG": {"quality": 95},
+        "WEBP": {"lossless": True, "exact": True, "method": 1, "quality": 25},
+        "lsb_format": "PNG",
+    },
+    "smallest": {
+        "PNG": {"compress_level": 9, "optimize": True},
+        "JPEG": {"quality": 85, "subsampling": 2, "optimize": True, "progressive": True},
+        # exact=True keeps the RGB values of fully transparent pixels, which hold LSB data too. Methods
+        # above 1 were measured 10-50x slower and no smaller on LSB-filled images.
+        "WEBP": {"lossless": True, "exact": True, "method": 1, "quality": 100},
+        "lsb_format": "WEBP",
+    },
+}
+
+def lsb_output_format(profile):
+    """Lossless format invisible watermarks are saved in with `profile`: PNG, or WEBP if Pillow supports it."""
+    output_format = OUTPUT_PROFILES[profile]["lsb_format"]
+    if output_format == "WEBP" and not features.check("webp"):
+        return "PNG"
+    return output_format
+
+def save_image(image, fp, output_format, profile="balanced"):
+    """
+    Saves an image with the encoder settings of an output profile.
+
+    Args:
+        image (Image.Image): The image to save. RGBA images are flattened to RGB for JPEG.
+        fp: File path or writable file object.
+        output_format (str): 'PNG', 'JPEG' or 'WEBP'.
+        profile (str): Name from OUTPUT_PROFILES.
+    """
+    save_kwargs = OUTPUT_PROFILES[profile].get(output_format, {})
+    if output_format == 'JPEG' and image.mode == 'RGBA':
+        image = image.convert('RGB')
+    image.save(fp, format=output_format, **save_kwargs)
+
+# --- Flask Web Application ---
+
+class StegaMarkRequest(Request):
+    """Request that buffers uploads in memory up to app.config['UPLOAD_SPOOL_BYTES'] and spools larger ones to a temporary file."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > app.config['UPLOAD_SPOOL_BYTES']:
+            return tempfile.TemporaryFile('rb+')
+        return io.BytesIO()
+
+app = Flask(__name__, static_folder='.') # Serve static files from root for simplicity
+app.request_class = StegaMarkRequest
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # Max upload size 16MB
-app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']
+app.config['UPLOAD_SPOOL_BYTES'] = int(os.environ.get('STEGAMARK_UPLOAD_SPOOL_BYTES', 1024 * 1024)) # Larger uploads go to disk
+app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp']
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', os.urandom(24)) # Use env var or random
+app.config['BATCH_WORKERS'] = int(os.environ.get('STEGAMARK_BATCH_WORKERS', os.cpu_count() or 1)) # Threads for /watermark/batch
+app.config['OUTPUT_PROFILE'] = os.environ.get('STEGAMARK_OUTPUT_PROFILE', 'balanced') # Default of the output_profile field
+app.config['PREVIEW_MAX_SIZE'] = int(os.environ.get('STEGAMARK_PREVIEW_MAX_SIZE', 1024)) # Largest /preview edge clients may ask for
+app.config['IMAGE_THREADS'] = int(os.environ.get('STEGAMARK_IMAGE_THREADS', 1)) # Threads working on bands of one image
+app.config['BATCH_MAX_IN_FLIGHT'] = app.config['BATCH_WORKERS'] * 2 # Encoded batch results held in memory at once
+app.config['RESULT_CACHE_ENABLED'] = os.environ.get('STEGAMARK_RESULT_CACHE', '0').lower() in ('1', 'true', 'yes') # Cache /watermark outputs
+app.config['RESULT_CACHE_MEMORY_BYTES'] = int(os.environ.get('STEGAMARK_RESULT_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+app.config['RESULT_CACHE_DIR'] = os.environ.get('STEGAMARK_RESULT_CACHE_DIR') # Disk tier; memory only if unset
+app.config['RESULT_CACHE_DISK_BYTES'] = int(os.environ.get('STEGAMARK_RESULT_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+app.config['JOB_WORKERS'] = int(os.environ.get('STEGAMARK_JOB_WORKERS', os.cpu_count() or 1)) # Threads running /jobs
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('STEGAMARK_JOB_QUEUE_SIZE', 32)) # Queued + running jobs per process before 503
+app.config['JOB_RESULT_DIR'] = os.environ.get('STEGAMARK_JOB_RESULT_DIR', os.path.join(tempfile.gettempdir(), 'stegamark-jobs'))
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('STEGAMARK_JOB_RESULT_TTL', 3600)) # Seconds finished jobs are kept
 
 # --- Refined Global Error Handlers ---
 
@@ -457,6 +1503,129 @@ def handle_generic_exception(e):
     return response
 # --- End Refined Error Handlers ---
 
+# --- Request Timing & Metrics ---
+
+class StageTimer:
+    """Collects the per-stage durations of one request for the Server-Timing header and /metrics."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.labels = {"mode": "", "strength": ""} # Filled in by the handler once known
+        self.stages = []                            # (stage name, seconds) in completion order
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing one stage of the request."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def elapsed(self):
+        """Seconds since the timer was created."""
+        return time.perf_counter() - self._start
+
+    def server_timing(self, total):
+        """Formats the stages and total as a Server-Timing header value (durations in ms)."""
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+class MetricsRegistry:
+    """Thread-safe request metrics rendered in the Prometheus text exposition format."""
+
+    # Histogram bucket upper bounds, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {} # (endpoint, stage, mode, strength) -> [bucket counts..., sum, count]
+        self._requests = {}   # (endpoint, mode, status) -> count
+
+    def observe_request(self, timer, status, total):
+        """Records every stage of a finished request plus its total duration and status."""
+        mode, strength = timer.labels["mode"], str(timer.labels["strength"])
+        with self._lock:
+            for stage, seconds in timer.stages + [("total", total)]:
+                key = (timer.endpoint, stage, mode, strength)
+                histogram = self._histograms.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+                for index, upper_bound in enumerate(self.BUCKETS):
+                    if seconds <= upper_bound:
+                        histogram[index] += 1
+                histogram[-2] += seconds
+                histogram[-1] += 1
+            request_key = (timer.endpoint, mode, str(status))
+            self._requests[request_key] = self._requests.get(request_key, 0) + 1
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = [
+            "# HELP stegamark_requests_total Requests handled, by endpoint, mode and status code.",
+            "# TYPE stegamark_requests_total counter",
+        ]
+        with self._lock:
+            for (endpoint, mode, status), count in sorted(self._requests.items()):
+                lines.append(f'stegamark_requests_total{{endpoint="{endpoint}",mode="{mode}",status="{status}"}} {count}')
+
+            lines += [
+                "# HELP stegamark_stage_duration_seconds Time spent per request stage.",
+                "# TYPE stegamark_stage_duration_seconds histogram",
+            ]
+            for (endpoint, stage, mode, strength), histogram in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{stage}",mode="{mode}",strength="{strength}"'
+                for upper_bound, count in zip(self.BUCKETS, histogram):
+                    lines.append(f'stegamark_stage_duration_seconds_bucket{{{labels},le="{upper_bound}"}} {count}')
+                lines.append(f'stegamark_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+                lines.append(f'stegamark_stage_duration_seconds_sum{{{labels}}} {histogram[-2]:.6f}')
+                lines.append(f'stegamark_stage_duration_seconds_count{{{labels}}} {histogram[-1]}')
+
+        cache_stats = element_cache.stats()
+        lines += [
+            "# HELP stegamark_element_cache_requests_total Watermark element cache lookups, by result.",
+            "# TYPE stegamark_element_cache_requests_total counter",
+            f'stegamark_element_cache_requests_total{{result="hit"}} {cache_stats["hits"]}',
+            f'stegamark_element_cache_requests_total{{result="miss"}} {cache_stats["misses"]}',
+            "# HELP stegamark_element_cache_entries Rendered watermark elements currently cached.",
+            "# TYPE stegamark_element_cache_entries gauge",
+            f'stegamark_element_cache_entries {cache_stats["size"]}',
+        ]
+        result_cache = _result_cache # Only reported once the result cache is in use
+        if result_cache is not None:
+            result_stats = result_cache.stats()
+            lines += [
+                "# HELP stegamark_result_cache_requests_total /watermark result cache lookups, by tier and result.",
+                "# TYPE stegamark_result_cache_requests_total counter",
+            ]
+            for tier in ("memory", "disk"):
+                if result_stats[tier] is not None:
+                    lines.append(f'stegamark_result_cache_requests_total{{tier="{tier}",result="hit"}} {result_stats[tier]["hits"]}')
+                    lines.append(f'stegamark_result_cache_requests_total{{tier="{tier}",result="miss"}} {result_stats[tier]["misses"]}')
+        return "\n".join(lines) + "\n"
+
+request_metrics = MetricsRegistry()
+
+def _start_stage_timer(endpoint):
+    """Creates the StageTimer for the current request; it is reported when the response is sent."""
+    g.stage_timer = StageTimer(endpoint)
+    return g.stage_timer
+
+@app.after_request
+def _report_stage_timings(response):
+    """Adds the Server-Timing header and records the request in request_metrics."""
+    timer = g.pop('stage_timer', None)
+    if timer is not None:
+        total = timer.elapsed()
+        response.headers['Server-Timing'] = timer.server_timing(total)
+        request_metrics.observe_request(timer, response.status_code, total)
+    return response
+
+@app.route('/metrics')
+def handle_metrics_request():
+    """Prometheus scrape endpoint with per-stage request histograms."""
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     # Serve index.html from the root directory
@@ -468,146 +1637,344 @@ def serve_static(path):
      # Be cautious with this in production - might expose unintended files
      return send_from_directory('.', path)
 
-@app.route('/watermark', methods=['POST'])
-def handle_watermark_request():
-    """Flask route to apply visible or invisible watermarks."""
-    # --- (Keep existing file checks) ---
-    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
-    image_file = request.files['image']
-    if image_file.filename == '': return jsonify({"error": "No selected image file"}), 400
+def _read_upload(file_storage):
+    """
+    Returns the bytes of an uploaded file without copying them.
+
+    In-memory uploads hand back the request buffer itself; uploads spooled to a temporary
+    file are memory-mapped, so large images never get a second copy on the Python heap.
+    Both stay valid after Flask closes the request files.
+
+    Returns:
+        bytes | mmap.mmap: The upload's contents (supports the buffer protocol).
+    """
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue() # Shares the BytesIO's buffer instead of copying it
+    stream.flush()
+    if os.fstat(stream.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _upload_stream(upload):
+    """Returns a file object reading an upload buffer from _read_upload from the start."""
+    if isinstance(upload, mmap.mmap):
+        upload.seek(0) # The mapping is its own file object; one reader at a time
+        return upload
+    return io.BytesIO(upload) # Wraps bytes without copying them
+
+# Largest tile gap accepted from clients, as a multiple of the watermark size
+MAX_TILE_SPACING = 10.0
+
+def _parse_watermark_options(form, files, image_size=None):
+    """
+    Reads and validates the watermark options of a /watermark-style request.
 
+    Logos are opened (and fully loaded) here, so the returned options can be shared
+    by several images, including across worker threads.
+
+    Args:
+        form: The request form (request.form).
+        files: The uploaded files (request.files).
+        image_size (tuple, optional): (width, height) of the image the options are for. When
+            known, JPEG logos are decoded at a reduced scale that still covers the size they
+            are drawn at.
+
+    Returns:
+        dict: Normalized options for _apply_watermark.
+
+    Raises:
+        ValueError: If an option is missing or invalid (reported to the client as 400).
+    """
     # --- Get Parameters ---
-    visibility = request.form.get('visibility', 'visible')
-    watermark_type = request.form.get('watermark_type', 'text') # 'text' or 'logo'
-    text = request.form.get('watermark_text', '')
+    visibility = form.get('visibility', 'visible')
+    watermark_type = form.get('watermark_type', 'text') # 'text' or 'logo'
+    text = form.get('watermark_text', '')
 
     # Parameters for Invisible
-    strength = request.form.get('strength', default=3, type=int)
+    strength = form.get('strength', default=3, type=int)
+    compression = form.get('compression', 'none').lower() # Payload codec, recorded in the watermark header
+    key = form.get('key') or None # Optional secret: scatter the payload in a keyed pixel order
+
+    # Encoder settings of the result (see OUTPUT_PROFILES)
+    output_profile = form.get('output_profile', app.config['OUTPUT_PROFILE']).lower()
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Output profile must be one of: {', '.join(OUTPUT_PROFILES)}")
 
     # Parameters for Visible
-    position = request.form.get('position', 'center') # Used if tile_style is 'none'
-    opacity = request.form.get('opacity', default=0.5, type=float)
-    logo_scale = request.form.get('logo_scale', default=0.15, type=float)
-    hex_color_str = request.form.get('text_color', '#ffffff')
+    position = form.get('position', 'center') # Used if tile_style is 'none'
+    opacity = form.get('opacity', default=0.5, type=float)
+    logo_scale = form.get('logo_scale', default=0.15, type=float)
+    hex_color_str = form.get('text_color', '#ffffff')
     rgb_color = hex_to_rgb(hex_color_str)
 
     # --- Tiling Parameters (NEW/UPDATED) ---
-    tile_style = request.form.get('tile_style', 'none').lower() # Get style: 'none', 'grid', 'staggered', 'diagonal'
-    tile_spacing = request.form.get('tile_spacing', default=0.1, type=float) # Get spacing factor (e.g., 0.1 = 10%)
-    tile_angle = request.form.get('tile_angle', default=45, type=int) # Get angle for diagonal style
+    tile_style = form.get('tile_style', 'none').lower() # Get style: 'none', 'grid', 'staggered', 'diagonal'
+    tile_spacing = form.get('tile_spacing', default=0.1, type=float) # Get spacing factor (e.g., 0.1 = 10%)
+    tile_angle = form.get('tile_angle', default=45, type=int) # Get angle for diagonal style
 
     # Validate tile_style
     allowed_styles = ['none', 'grid', 'staggered', 'diagonal']
     if tile_style not in allowed_styles:
         print(f"Warning: Invalid tile_style '{tile_style}' received. Defaulting to 'none'.", file=sys.stderr)
         tile_style = 'none'
+    # Logo width as a fraction of the image width: a logo wider than the image is never useful
+    if not 0.01 <= logo_scale <= 1.0:
+        print(f"Warning: Invalid logo_scale '{logo_scale}' received. Clamping to 0.01-1.0.", file=sys.stderr)
+        logo_scale = min(1.0, max(0.01, logo_scale))
     # Basic validation for spacing (prevent negative values)
     if tile_spacing < 0:
         print(f"Warning: Invalid negative tile_spacing '{tile_spacing}' received. Using 0.", file=sys.stderr)
         tile_spacing = 0
+    elif tile_spacing > MAX_TILE_SPACING:
+        print(f"Warning: tile_spacing '{tile_spacing}' too large. Using {MAX_TILE_SPACING}.", file=sys.stderr)
+        tile_spacing = MAX_TILE_SPACING
+
+    options = {
+        "visibility": visibility, "watermark_type": watermark_type, "text": text, "strength": strength,
+        "position": position, "opacity": opacity, "logo_scale": logo_scale, "text_color": rgb_color,
+        "tile_style": tile_style, "tile_spacing": tile_spacing, "tile_angle": tile_angle,
+        "logo_image": None, "secret_data": None, "compression": compression, "key": key,
+        "output_profile": output_profile,
+    }
+
+    if visibility == 'visible':
+        if watermark_type == 'logo':
+            if 'watermark_logo' not in files or files['watermark_logo'].filename == '':
+                raise ValueError("Logo file required for visible logo watermark")
+            logo_file = files['watermark_logo']
+            logo_ext = os.path.splitext(logo_file.filename)[1].lower()
+            if logo_ext not in app.config['UPLOAD_EXTENSIONS']:
+                 raise ValueError(f"Invalid logo file type: {logo_ext}")
+            try:
+                logo_image = Image.open(_upload_stream(_read_upload(logo_file)))
+                if image_size is not None:
+                    # Only JPEG implements draft(); other formats ignore it and decode at full size
+                    logo_width = max(1, int(image_size[0] * logo_scale))
+                    logo_height = max(1, math.ceil(logo_width * logo_image.height / logo_image.width))
+                    logo_image.draft(None, (logo_width, logo_height))
+                logo_image.load()
+            except UnidentifiedImageError: raise ValueError("Cannot identify logo file.")
+            options["logo_image"] = logo_image
+        elif watermark_type == 'text' and not text:
+             raise ValueError("Watermark text cannot be empty for text type")
+
+    elif visibility == 'invisible':
+        if watermark_type == 'text':
+            if not text: raise ValueError("Text message required for invisible")
+            options["secret_data"] = pack_payload("text", text.encode('utf-8'), compression="none") # Compressed as a whole below
+        elif watermark_type == 'logo':
+            if 'watermark_logo' not in files or files['watermark_logo'].filename == '':
+                raise ValueError("Logo file required for invisible logo")
+            logo_file = files['watermark_logo']
+            try:
+                logo_bytes = _read_upload(logo_file)
+                logo_image_inv = Image.open(_upload_stream(logo_bytes)) # Reads only the header
+                if logo_image_inv.format != 'PNG': # PNG logos are embedded as uploaded, without a decode/re-encode
+                    logo_bytes_io = io.BytesIO()
+                    logo_image_inv.save(logo_bytes_io, format='PNG')
+                    logo_bytes = logo_bytes_io.getvalue()
+            except UnidentifiedImageError: raise ValueError("Cannot identify logo file.")
+            options["secret_data"] = pack_payload("image", logo_bytes, fmt="png", compression="none")
+        else: raise ValueError("Invalid type for invisible watermark")
+
+        if not 1 <= strength <= 5: raise ValueError("Strength must be 1-5")
+        if compression != 'auto' and compression not in available_codecs():
+            raise ValueError(f"Compression must be 'auto' or one of: {', '.join(available_codecs())}")
+
+    else:
+        raise ValueError("Invalid visibility option")
+
+    return options
+
+def _prepare_embedding_plan(options):
+    """Prepares the invisible payload of `options` (from _parse_watermark_options) for embedding."""
+    steg = LSBSteganography(options["strength"], compression=options["compression"], key=options["key"])
+    return steg.prepare(options["secret_data"])
+
+def _visible_watermark_kwargs(options):
+    """Keyword arguments for add_visible_watermark from the visible watermark `options` (from _parse_watermark_options)."""
+    return dict(
+        text=options["text"] if options["watermark_type"] == 'text' else None,
+        logo_image=options["logo_image"],
+        position=options["position"],         # Used only if tile_style='none'
+        opacity=options["opacity"],
+        logo_scale=options["logo_scale"],
+        text_color=options["text_color"],
+        tile_style=options["tile_style"],     # Pass the chosen style
+        tile_spacing=options["tile_spacing"], # Pass the spacing factor
+        tile_angle=options["tile_angle"],     # Pass the angle for diagonal
+        # font_path/font_size could be added here if needed from form
+    )
+
+def _apply_watermark(base_image, options):
+    """
+    Applies the watermark described by `options` (from _parse_watermark_options) to an image.
+
+    Returns:
+        tuple: (result Image, output format 'PNG', 'JPEG' or, for invisible watermarks, 'WEBP')
+    """
+    original_format = base_image.format or 'PNG'
+    if options["visibility"] == 'visible':
+        # Call the updated function with new tiling parameters
+        result_image = add_visible_watermark(base_image, threads=app.config['IMAGE_THREADS'],
+                                             **_visible_watermark_kwargs(options))
+        # Keep JPEG inputs as JPEG, everything else becomes PNG
+        output_format = 'JPEG' if original_format.upper() in ['JPEG', 'JPG'] else 'PNG'
+    else:
+        plan = options.get("embedding_plan") or _prepare_embedding_plan(options)
+        result_image = plan.apply(base_image, threads=app.config['IMAGE_THREADS'])
+        output_format = lsb_output_format(options["output_profile"]) # MUST be lossless for LSB
+    return result_image, output_format
+
+def _save_result_image(result_image, output_format, fp, profile="balanced"):
+    """Saves a watermarked image to a file object with the encoder settings of an output profile."""
+    save_image(result_image, fp, output_format, profile)
+
+def _result_filename(upload_filename, output_format):
+    """Download filename for a watermarked upload, e.g. 'photo.jpg' -> 'watermarked_photo.jpeg'."""
+    return f"watermarked_{os.path.splitext(upload_filename)[0]}.{output_format.lower()}"
+
+class ResultCache:
+    """
+    Two-tier cache of encoded /watermark results: an in-memory LRU in front of an optional
+    on-disk LRU, both bounded by total bytes. Values are (encoded bytes, output format).
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory = LRUCache(maxsize=sys.maxsize, maxbytes=memory_bytes, sizeof=lambda value: len(value[0]))
+        self.disk = DiskLRUCache(disk_dir, disk_bytes) if disk_dir else None
+
+    def get(self, key):
+        """Returns (data, output_format) for `key`, or None on a miss."""
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                output_format, _, data = stored.partition(b"\n")
+                value = (data, output_format.decode('ascii'))
+                self.memory.put(key, value) # Promote so repeat hits skip the disk read
+        return value
+
+    def put(self, key, data, output_format):
+        self.memory.put(key, (data, output_format))
+        if self.disk is not None:
+            self.disk.put(key, output_format.encode('ascii') + b"\n" + data)
+
+    def stats(self):
+        """Returns the memory and disk tier statistics."""
+        return {"memory": self.memory.stats(), "disk": self.disk.stats() if self.disk is not None else None}
+
+# Result cache for /watermark, created on first use when app.config['RESULT_CACHE_ENABLED'] is set
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def _get_result_cache():
+    """Returns the shared ResultCache, or None if result caching is disabled."""
+    global _result_cache
+    if not app.config['RESULT_CACHE_ENABLED']:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(app.config['RESULT_CACHE_MEMORY_BYTES'],
+                                        app.config['RESULT_CACHE_DIR'], app.config['RESULT_CACHE_DISK_BYTES'])
+        return _result_cache
+
+RESULT_CACHE_VERSION = 2 # Bump when the output for the same inputs changes, to invalidate cached results
+
+def _result_cache_key(image_bytes, options):
+    """
+    Content address of a /watermark result: a hash of the uploaded bytes and the options that affect the output.
+
+    The options are normalized first, so fields ignored by the chosen mode (e.g. the position of
+    a tiled watermark) do not split the cache.
+    """
+    if options["visibility"] == 'invisible':
+        params = {"strength": options["strength"], "compression": options["compression"]} # secret_data covers the rest
+    else:
+        params = {key: options[key] for key in ("watermark_type", "opacity", "tile_style")}
+        if options["watermark_type"] == 'text':
+            params.update(text=options["text"], text_color=list(options["text_color"]))
+        else:
+            params.update(logo=_logo_digest(options["logo_image"]), logo_scale=options["logo_scale"])
+        if options["tile_style"] == 'none':
+            params["position"] = options["position"]
+        else:
+            params["tile_spacing"] = options["tile_spacing"]
+            if options["tile_style"] == 'diagonal':
+                params["tile_angle"] = options["tile_angle"]
+    params.update(visibility=options["visibility"], output_profile=options["output_profile"], version=RESULT_CACHE_VERSION)
+
+    digest = hashlib.sha256(hashlib.sha256(image_bytes).digest())
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    if options["secret_data"] is not None:
+        digest.update(hashlib.sha256(options["secret_data"]).digest())
+    if options["visibility"] == 'invisible' and options["key"] is not None:
+        digest.update(b"key:" + hashlib.sha256(options["key"].encode('utf-8')).digest())
+    return digest.hexdigest()
+
+@app.route('/watermark', methods=['POST'])
+def handle_watermark_request():
+    """Flask route to apply visible or invisible watermarks."""
+    timer = _start_stage_timer('watermark')
+    # --- (Keep existing file checks) ---
+    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
+    image_file = request.files['image']
+    if image_file.filename == '': return jsonify({"error": "No selected image file"}), 400
 
     # --- (Keep existing file extension validation) ---
     file_ext = os.path.splitext(image_file.filename)[1].lower()
     if file_ext not in app.config['UPLOAD_EXTENSIONS']:
          return jsonify({"error": f"Invalid image file type: {file_ext}"}), 400
 
+    upload = _read_upload(image_file)
     # --- (Keep existing image opening try/except block) ---
     try:
-        base_image = Image.open(image_file.stream)
-        original_format = base_image.format or 'PNG'
-        result_image = None
-        output_format = 'PNG'
+        with timer.stage('open'):
+            base_image = Image.open(_upload_stream(upload)) # Reads only the header; pixels are decoded below
     except UnidentifiedImageError: return jsonify({"error": "Cannot identify image file."}), 400
     except Exception as e: return jsonify({"error": f"Error opening image: {str(e)}"}), 500
 
     try:
-        if visibility == 'visible':
-            logo_image = None
-            if watermark_type == 'logo':
-                # --- (Keep existing logo loading logic) ---
-                if 'watermark_logo' not in request.files or request.files['watermark_logo'].filename == '':
-                    return jsonify({"error": "Logo file required for visible logo watermark"}), 400
-                logo_file = request.files['watermark_logo']
-                logo_ext = os.path.splitext(logo_file.filename)[1].lower()
-                if logo_ext not in app.config['UPLOAD_EXTENSIONS']:
-                     return jsonify({"error": f"Invalid logo file type: {logo_ext}"}), 400
-                try:
-                    logo_image = Image.open(logo_file.stream)
-                except UnidentifiedImageError: return jsonify({"error": "Cannot identify logo file."}), 400
-                except Exception as e: return jsonify({"error": f"Error opening logo: {str(e)}"}), 500
-            elif watermark_type == 'text' and not text:
-                 return jsonify({"error": "Watermark text cannot be empty for text type"}), 400
-
-            # Call the updated function with new tiling parameters
-            result_image = add_visible_watermark(
-                base_image,
-                text=text if watermark_type == 'text' else None,
-                logo_image=logo_image,
-                position=position,      # Used only if tile_style='none'
-                opacity=opacity,
-                logo_scale=logo_scale,
-                text_color=rgb_color,
-                tile_style=tile_style,    # Pass the chosen style
-                tile_spacing=tile_spacing,# Pass the spacing factor
-                tile_angle=tile_angle     # Pass the angle for diagonal
-                # font_path/font_size could be added here if needed from form
-            )
-            # --- (Keep existing output format determination logic) ---
-            if original_format.upper() in ['JPEG', 'JPG']: output_format = 'JPEG'
-            else: output_format = 'PNG'
-
-        elif visibility == 'invisible':
-            # --- (Keep ALL existing invisible logic untouched) ---
-            # ... (invisible encoding logic using LSBSteganography) ...
-            # This section remains exactly as it was before.
-            if watermark_type == 'text':
-                if not text: return jsonify({"error": "Text message required for invisible"}), 400
-                import json
-                metadata = {"watermark_type": "text", "content": text}
-                secret_data = json.dumps(metadata).encode('utf-8')
-            elif watermark_type == 'logo':
-                if 'watermark_logo' not in request.files or request.files['watermark_logo'].filename == '':
-                    return jsonify({"error": "Logo file required for invisible logo"}), 400
-                logo_file = request.files['watermark_logo']
-                # ... (rest of invisible logo loading/validation/conversion) ...
-                try:
-                    logo_image_inv = Image.open(logo_file.stream)
-                    logo_bytes_io = io.BytesIO()
-                    logo_image_inv.save(logo_bytes_io, format='PNG')
-                    logo_bytes = logo_bytes_io.getvalue()
-                    import json
-                    metadata = {
-                        "watermark_type": "image", "format": "png",
-                        "content": base64.b64encode(logo_bytes).decode('ascii')
-                    }
-                    secret_data = json.dumps(metadata).encode('utf-8')
-                except UnidentifiedImageError: return jsonify({"error": "Cannot identify logo file."}), 400
-                except Exception as e: return jsonify({"error": f"Error processing logo for invisible: {str(e)}"}), 500
-            else: return jsonify({"error": "Invalid type for invisible watermark"}), 400
-
-            if not 1 <= strength <= 5: return jsonify({"error": "Strength must be 1-5"}), 400
-            steg = LSBSteganography(strength)
-            result_image = steg.encode_image(base_image, secret_data)
-            output_format = 'PNG' # MUST be PNG for LSB
+        with timer.stage('options'):
+            options = _parse_watermark_options(request.form, request.files, base_image.size)
+        timer.labels.update(mode=options["visibility"],
+                            strength=options["strength"] if options["visibility"] == 'invisible' else "")
+
+        result_cache = _get_result_cache()
+        cache_key = None
+        if result_cache is not None:
+            with timer.stage('cache'):
+                cache_key = _result_cache_key(upload, options)
+                cached = result_cache.get(cache_key)
+            if request.if_none_match.contains(cache_key):
+                # The output is fully determined by the key, so the client's copy is current even if it was evicted here
+                return Response(status=304, headers={"ETag": f'"{cache_key}"'})
+            if cached is not None:
+                output_bytes, output_format = cached
+                return _watermark_response(output_bytes, output_format, image_file.filename, cache_key, "HIT")
 
-        else:
-            return jsonify({"error": "Invalid visibility option"}), 400
+        try:
+            with timer.stage('decode'):
+                base_image.load()
+        except Exception as e: return jsonify({"error": f"Error opening image: {str(e)}"}), 500
+
+        with timer.stage('lsb' if options["visibility"] == 'invisible' else 'composite'):
+            result_image, output_format = _apply_watermark(base_image, options)
 
         # --- (Keep existing response preparation and sending logic) ---
         if result_image:
             byte_io = io.BytesIO()
-            save_kwargs = {}
-            if output_format == 'JPEG':
-                 save_kwargs['quality'] = 95
-                 if result_image.mode == 'RGBA': result_image = result_image.convert('RGB')
-            elif output_format == 'PNG':
-                 save_kwargs['compress_level'] = 1
-
-            result_image.save(byte_io, format=output_format, **save_kwargs)
-            byte_io.seek(0)
-            mime_type = f'image/{output_format.lower()}'
-            download_filename = f"watermarked_{os.path.splitext(image_file.filename)[0]}.{output_format.lower()}"
-            return send_file(byte_io, mimetype=mime_type, as_attachment=True, download_name=download_filename)
+            with timer.stage('save'):
+                _save_result_image(result_image, output_format, byte_io, options["output_profile"])
+            if cache_key is None:
+                byte_io.seek(0)
+                mime_type = f'image/{output_format.lower()}'
+                download_filename = _result_filename(image_file.filename, output_format)
+                return send_file(byte_io, mimetype=mime_type, as_attachment=True, download_name=download_filename)
+            output_bytes = byte_io.getvalue()
+            result_cache.put(cache_key, output_bytes, output_format)
+            return _watermark_response(output_bytes, output_format, image_file.filename, cache_key, "MISS")
         else:
              return jsonify({"error": "Watermarking process failed unexpectedly."}), 500
 
@@ -629,9 +1996,253 @@ def handle_watermark_request():
         # Or explicitly return JSON here too as a safeguard:
         return jsonify({"error": "An internal server error occurred during watermarking."}), 500
 
+def _watermark_response(output_bytes, output_format, upload_filename, cache_key, cache_status):
+    """Download response for a cached or freshly cached /watermark result, tagged with its content address."""
+    response = send_file(io.BytesIO(output_bytes), mimetype=f'image/{output_format.lower()}', as_attachment=True,
+                         download_name=_result_filename(upload_filename, output_format), etag=cache_key)
+    response.headers["X-Cache"] = cache_status
+    return response
+
+# Worker pool for /watermark/batch, created on first use
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def _get_batch_executor():
+    """Returns the shared thread pool that processes batch items (sized by app.config['BATCH_WORKERS'])."""
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_WORKERS'],
+                                                 thread_name_prefix="stegamark-batch")
+        return _batch_executor
+
+def _watermark_batch_item(filename, image_bytes, options, progress=None):
+    """
+    Watermarks one uploaded image of a batch.
+
+    Args:
+        progress (callable, optional): Called as progress(fraction, stage) as the item advances.
+
+    Returns:
+        tuple: (output filename, encoded image bytes)
+
+    Raises:
+        ValueError: For client-side problems with this item (bad type, unreadable image, too much data).
+    """
+    file_ext = os.path.splitext(filename)[1].lower()
+    if file_ext not in app.config['UPLOAD_EXTENSIONS']:
+        raise ValueError(f"Invalid image file type: {file_ext}")
+    progress = progress or (lambda fraction, stage: None)
+    try:
+        base_image = Image.open(_upload_stream(image_bytes))
+        base_image.load()
+    except UnidentifiedImageError:
+        raise ValueError("Cannot identify image file.")
+    progress(0.2, 'lsb' if options["visibility"] == 'invisible' else 'composite')
+    result_image, output_format = _apply_watermark(base_image, options)
+    progress(0.8, 'save')
+    byte_io = io.BytesIO()
+    _save_result_image(result_image, output_format, byte_io, options["output_profile"])
+    return _result_filename(filename, output_format), byte_io.getvalue()
+
+@app.route('/watermark/batch', methods=['POST'])
+def handle_watermark_batch_request():
+    """
+    Flask route to watermark many images with one shared set of options.
+
+    Accepts any number of 'image' parts plus the same form fields as /watermark and streams back a
+    ZIP archive with one result per image and a manifest.json. Items that fail are listed in the
+    manifest with their error instead of failing the whole batch.
+    """
+    # Read the uploads now: Flask closes request files when the view returns, before the response streams
+    uploads = [(f.filename, _read_upload(f)) for f in request.files.getlist('image') if f.filename]
+    if not uploads: return jsonify({"error": "No image files provided"}), 400
+
+    try:
+        options = _parse_watermark_options(request.form, request.files)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnidentifiedImageError as e:
+        return jsonify({"error": f"Cannot identify logo file: {e}"}), 400
+
+    if options["visibility"] == 'invisible':
+        # Every image gets the same payload: compress and split it into bit groups once for the whole batch
+        options["embedding_plan"] = _prepare_embedding_plan(options)
+
+    def process(upload):
+        return _watermark_batch_item(upload[0], upload[1], options)
+
+    def archive_entries():
+        # Results are encoded on the pool and written into the archive in upload order
+        manifest = []
+        used_names = set()
+        futures = iter_bounded(_get_batch_executor(), process, uploads, app.config['BATCH_MAX_IN_FLIGHT'])
+        for (filename, _), future in zip(uploads, futures):
+            entry = {"input": filename}
+            try:
+                output_name, output_bytes = future.result()
+            except (ValueError, UnidentifiedImageError) as e:
+                entry.update(status="error", error=str(e))
+            except Exception as e:
+                print(f"Generic Exception in /watermark/batch for {filename}: {e}", file=sys.stderr)
+                traceback.print_exc()
+                entry.update(status="error", error="An internal server error occurred during watermarking.")
+            else:
+                # Keep archive names unique when several uploads share a filename
+                base_name, ext = os.path.splitext(output_name)
+                counter = 1
+                while output_name in used_names:
+                    output_name = f"{base_name}_{counter}{ext}"
+                    counter += 1
+                used_names.add(output_name)
+                entry.update(status="ok", output=output_name)
+                yield output_name, output_bytes
+            manifest.append(entry)
+
+        failed = sum(1 for entry in manifest if entry["status"] != "ok")
+        yield "manifest.json", json.dumps({"total": len(manifest), "failed": failed, "items": manifest}, indent=2).encode('utf-8')
+
+    # Stream the archive as results complete instead of materialising it in memory
+    return Response(stream_with_context(iter_zip_stream(archive_entries())), mimetype='application/zip',
+                    headers={"Content-Disposition": "attachment; filename=watermarked_batch.zip"})
+
+def _describe_extracted_data(extracted_data_bytes):
+    """
+    Interprets extracted bytes for the /extract JSON response.
+
+    Recognizes the payload container written by /watermark and the JSON metadata of older
+    images (text or image watermark), falls back to plain UTF-8 text and finally reports
+    non-text data as binary.
+
+    Returns:
+        dict: JSON-serializable description of the extracted data.
+
+    Raises:
+        ValueError: If the data is a damaged payload container.
+    """
+    payload = unpack_payload(extracted_data_bytes)
+    if payload is not None:
+        if payload["watermark_type"] == "text":
+            return {"extracted_text": payload["content"].decode('utf-8', errors='replace')}
+        return {
+            "extracted_text": "Image watermark detected",
+            "is_image": True,
+            "image_data": base64.b64encode(payload["content"]).decode('ascii')
+        }
+
+    try:
+        extracted_text = extracted_data_bytes.decode('utf-8')
+        print(f"DEBUG: Decoded as UTF-8: '{extracted_text[:100]}...'") # Add log
+
+        # Try to parse as JSON (for metadata structure)
+        try:
+            metadata = json.loads(extracted_text)
+            print("DEBUG: Parsed as JSON successfully.") # Add log
+
+            if isinstance(metadata, dict) and "content" in metadata:
+                content = metadata["content"] # Get the content
+                watermark_type = metadata.get("watermark_type")
+                print(f"DEBUG: Found metadata - type: {watermark_type}") # Add log
+
+                if watermark_type == "text":
+                    extracted_string = str(content) if content is not None else ""
+                    print(f"DEBUG: Returning text content: '{extracted_string[:100]}...'") # Add log
+                    return {"extracted_text": extracted_string}
+
+                elif watermark_type == "image":
+                    if isinstance(content, str):
+                        print("DEBUG: Returning image watermark data.") # Add log
+                        return {
+                            "extracted_text": "Image watermark detected",
+                            "is_image": True,
+                            "image_data": content
+                        }
+                    else:
+                        print("DEBUG: Returning image watermark with invalid content format.") # Add log
+                        return {
+                            "extracted_text": "Image watermark detected, but content data format is invalid.",
+                            "is_binary": True
+                        }
+                else:
+                    # Known JSON structure but unknown watermark_type
+                    print(f"DEBUG: JSON parsed, but unknown watermark_type ('{watermark_type}'). Treating as plain text.") # Add log
+                    # Fall through to return the raw text (which is the JSON string itself)
+                    pass
+
+            else:
+                 # JSON parsed, but not the expected dict structure with 'content'
+                 print("DEBUG: JSON parsed, but not the expected metadata structure. Treating as plain text.") # Add log
+                 # Fall through to return the raw text (which is the JSON string itself)
+                 pass
+
+
+        except (json.JSONDecodeError, TypeError) as json_err:
+            # Not valid JSON, treat as plain text
+            print(f"DEBUG: Not valid JSON ({json_err}). Returning as plain text.") # Add log
+            # Fall through to return the raw decoded text below
+
+        # --- Fall-through cases ---
+        # If JSON parsing failed OR it parsed but wasn't the expected structure/type,
+        # return the raw decoded text. The frontend should display this.
+        print(f"DEBUG: Falling through JSON handling. Returning raw decoded text: '{extracted_text[:100]}...'") # Add log
+        return {"extracted_text": extracted_text}
+
+    except UnicodeDecodeError:
+        # Handle non-UTF8 data
+        extracted_info = f"Extracted {len(extracted_data_bytes)} bytes (non-UTF8 data)"
+        print("DEBUG: Data is not valid UTF-8. Returning binary info.") # Add log
+        return {"extracted_text": extracted_info, "is_binary": True}
+
+def _run_extraction(encoded_image, strength, allow_legacy=True, timer=None, key=None):
+    """
+    Extracts and describes the invisible watermark of an opened image.
+
+    Args:
+        encoded_image (PIL.Image.Image): The image to read.
+        strength (int | None): Encoding strength 1-5, or None to detect it from the image.
+        allow_legacy (bool): Whether images without a v2 header may be scanned for the legacy delimiter.
+        timer (StageTimer, optional): Receives the 'detect' and 'lsb' stage timings.
+        key (str, optional): Key of a keyed watermark.
+
+    Returns:
+        dict | None: The /extract JSON response including "strength", or None if strength
+                     detection found no watermark.
+
+    Raises:
+        ValueError: If the data cannot be decoded at the given strength.
+    """
+    timer = timer or StageTimer('extract')
+    if strength is None:
+        with timer.stage('detect'):
+            strength = LSBSteganography.detect_strength(encoded_image, key=key, threads=app.config['IMAGE_THREADS'])
+        if strength is None:
+            return None
+
+    timer.labels["strength"] = strength
+    steg = LSBSteganography(strength, key=key, threads=app.config['IMAGE_THREADS'])
+    with timer.stage('lsb'):
+        extracted_data_bytes = steg.decode_image(encoded_image, allow_legacy=allow_legacy)
+    print(f"DEBUG: Extracted {len(extracted_data_bytes)} bytes.") # Add log
+
+    result = _describe_extracted_data(extracted_data_bytes)
+    result["strength"] = strength
+    return result
+
+def _extraction_error_message(error):
+    """Client-facing message for a decode ValueError, listing the usual causes."""
+    return (
+        f"{error}. Possible causes: "
+        "1) Incorrect 'Strength' setting (must match encoding strength). "
+        "2) Image was modified after encoding (e.g., re-saved, compressed, edited). "
+        "3) No watermark exists with the specified strength. "
+        "Please use the original, unmodified PNG file."
+    )
+
 @app.route('/extract', methods=['POST'])
 def handle_extract_request():
     """Flask route to extract invisible watermarks."""
+    timer = _start_stage_timer('extract')
+    timer.labels["mode"] = 'extract'
     if 'image' not in request.files:
         return jsonify({"error": "No image file provided for extraction"}), 400
 
@@ -639,148 +2250,702 @@ def handle_extract_request():
     if image_file.filename == '':
         return jsonify({"error": "No selected image file"}), 400
 
-    strength = request.form.get('strength', default=3, type=int)
+    # 'auto' detects the strength from the image instead of requiring the encoding strength
+    strength_value = request.form.get('strength', '3').strip().lower()
+    auto_strength = strength_value == 'auto'
+    # 'false' rejects images without a v2 header instead of scanning them for the legacy delimiter
+    allow_legacy = request.form.get('legacy', 'true').lower() != 'false'
+    key = request.form.get('key') or None # Needed for watermarks embedded with a key
 
-    if not 1 <= strength <= 5:
-        return jsonify({"error": "Strength must be between 1 and 5"}), 400
+    if not auto_strength:
+        try:
+            strength = int(strength_value)
+        except ValueError:
+            return jsonify({"error": "Strength must be between 1 and 5 or 'auto'"}), 400
+        if not 1 <= strength <= 5:
+            return jsonify({"error": "Strength must be between 1 and 5"}), 400
+        timer.labels["strength"] = strength
 
-    # Check if the uploaded file appears to be PNG based on filename/content type
-    is_likely_png = image_file.filename.lower().endswith('.png') or image_file.mimetype == 'image/png'
+    # Check if the uploaded file appears to be PNG (or WebP, written by the 'smallest' output profile) based on filename/content type
+    is_likely_png = image_file.filename.lower().endswith(('.png', '.webp')) or image_file.mimetype in ('image/png', 'image/webp')
     if not is_likely_png:
          print(f"Warning: Extraction attempted on non-PNG file: {image_file.filename} ({image_file.mimetype})", file=sys.stderr)
 
     try:
-        encoded_image = Image.open(image_file.stream)
+        with timer.stage('open'):
+            encoded_image = Image.open(image_file.stream)
+            encoded_image.load() # Decode now so the decoding time is reported as its own stage
     except UnidentifiedImageError:
         return jsonify({"error": "Cannot identify image file. Corrupted or unsupported?"}), 400
     except Exception as e:
         return jsonify({"error": f"Error opening image: {str(e)}"}), 500
 
     try:
-        steg = LSBSteganography(strength)
-        extracted_data_bytes = steg.decode_image(encoded_image)
-        print(f"DEBUG: Extracted {len(extracted_data_bytes)} bytes.") # Add log
+        result = _run_extraction(encoded_image, None if auto_strength else strength, allow_legacy, timer, key)
+        if result is None:
+            return jsonify({"error": "No watermark detected at any strength. "
+                                     "Please use the original, unmodified PNG file."}), 400
+        return jsonify(result)
+
+    except ValueError as e:
+        # Specific error from decode (delimiter not found)
+        print(f"ERROR: ValueError during decode: {e}") # Add log
+        return jsonify({"error": _extraction_error_message(e)}), 400
+    except Exception as e:
+        print(f"ERROR: Unexpected error during extraction process: {e}", file=sys.stderr) # Add log
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": "An internal server error occurred during extraction."}), 500
+
+@app.route('/capacity', methods=['POST'])
+def handle_capacity_request():
+    """
+    Flask route reporting the invisible watermark capacity of an image at every strength.
+
+    Only the image header is read, so this is cheap enough to call before /watermark.
+    An optional payload is checked against each capacity, as stored with and without
+    compression: either 'watermark_text'/'watermark_logo' (built exactly as /watermark
+    would embed them) or a raw 'payload' file.
+    """
+    timer = _start_stage_timer('capacity')
+    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
+    image_file = request.files['image']
+    if image_file.filename == '': return jsonify({"error": "No selected image file"}), 400
+
+    try:
+        with timer.stage('open'):
+            image = Image.open(_upload_stream(_read_upload(image_file))) # Reads only the header
+    except UnidentifiedImageError: return jsonify({"error": "Cannot identify image file."}), 400
+
+    payload = None
+    compression = request.form.get('compression', 'auto').lower() # Same default as the capacity CLI command
+    try:
+        if 'payload' in request.files and request.files['payload'].filename:
+            payload = bytes(_read_upload(request.files['payload']))
+        elif request.form.get('watermark_text') or ('watermark_logo' in request.files and request.files['watermark_logo'].filename):
+            form = request.form.copy()
+            form['visibility'] = 'invisible'
+            if 'watermark_type' not in form:
+                form['watermark_type'] = 'text' if request.form.get('watermark_text') else 'logo'
+            options = _parse_watermark_options(form, request.files)
+            payload = options["secret_data"]
+        if compression != 'auto' and compression not in available_codecs():
+            raise ValueError(f"Compression must be 'auto' or one of: {', '.join(available_codecs())}")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    report = capacity_report(image.width, image.height, payload, compression)
+    report.update(mode=image.mode, format=image.format)
+    return jsonify(report)
+
+# --- Previews ---
+
+# Rendered /preview JPEGs by content address, bounded by their total size
+preview_cache = LRUCache(maxsize=sys.maxsize, maxbytes=int(os.environ.get('STEGAMARK_PREVIEW_CACHE_BYTES', 32 * 1024 * 1024)))
+
+def open_preview_image(fp, max_size):
+    """
+    Opens an image decoded at reduced size, fitting within max_size x max_size pixels.
+
+    JPEGs are decoded at 1/2 to 1/8 scale by the decoder itself (draft mode); other formats
+    are decoded in full and reduced.
+
+    Returns:
+        tuple: (preview Image, width of the full-size image, height of the full-size image)
+    """
+    image = Image.open(fp)
+    full_width, full_height = image.size
+    image.draft(None, (max_size, max_size)) # Only JPEG implements draft(); other formats ignore it
+    image.thumbnail((max_size, max_size))
+    return image, full_width, full_height
+
+def render_preview(image, full_width, full_height, **watermark_kwargs):
+    """
+    Draws a visible watermark on a downscaled image as it would look on the full-size image.
+
+    Sizes add_visible_watermark derives from the image (logo width) and fractional settings
+    (tile spacing) scale by themselves; the default font size and the edge padding are pixel
+    values of the full-size image, so they are scaled down here.
 
+    Args:
+        image (Image.Image): The downscaled image, e.g. from open_preview_image.
+        full_width (int): Width of the full-size image.
+        full_height (int): Height of the full-size image.
+        **watermark_kwargs: add_visible_watermark arguments, as for the full-size image.
+
+    Returns:
+        Image.Image: The watermarked preview.
+    """
+    scale = image.width / full_width
+    if watermark_kwargs.get("text") and watermark_kwargs.get("font_size") is None:
+        watermark_kwargs["font_size"] = max(10, int(full_height * 0.05)) # add_visible_watermark's default at full size
+    if watermark_kwargs.get("font_size") is not None:
+        watermark_kwargs["font_size"] = max(1, round(watermark_kwargs["font_size"] * scale))
+    watermark_kwargs["padding"] = round(watermark_kwargs.get("padding", 10) * scale)
+    return add_visible_watermark(image, **watermark_kwargs)
+
+@app.route('/preview', methods=['POST'])
+def handle_preview_request():
+    """
+    Flask route rendering a small JPEG preview of a visible watermark.
+
+    Takes the same form fields as /watermark (visible watermarks only) plus 'max_size', the
+    longest edge of the preview in pixels (default 512). The image is decoded at reduced size
+    and the watermark drawn to scale, so a tile layout can be checked without processing the
+    full-resolution image. Previews are cached by the hash of the upload and the options.
+    """
+    timer = _start_stage_timer('preview')
+    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
+    image_file = request.files['image']
+    if image_file.filename == '': return jsonify({"error": "No selected image file"}), 400
+    file_ext = os.path.splitext(image_file.filename)[1].lower()
+    if file_ext not in app.config['UPLOAD_EXTENSIONS']:
+         return jsonify({"error": f"Invalid image file type: {file_ext}"}), 400
+
+    try:
+        max_size = request.form.get('max_size', default=512, type=int)
+        if not 16 <= max_size <= app.config['PREVIEW_MAX_SIZE']:
+            raise ValueError(f"max_size must be between 16 and {app.config['PREVIEW_MAX_SIZE']}")
+        if request.form.get('visibility', 'visible') != 'visible':
+            raise ValueError("Previews are only available for visible watermarks.")
+
+        upload = _read_upload(image_file)
+        with timer.stage('open'):
+            base_image = Image.open(_upload_stream(upload)) # Reads only the header
+        with timer.stage('options'):
+            # Logos are only drawn at preview size, so JPEG logos can be decoded at that scale too
+            ratio = min(1.0, max_size / max(base_image.size))
+            preview_size = (max(1, round(base_image.width * ratio)), max(1, round(base_image.height * ratio)))
+            options = _parse_watermark_options(request.form, request.files, preview_size)
+
+        with timer.stage('cache'):
+            cache_key = hashlib.sha256(f"{_result_cache_key(upload, options)}:{max_size}".encode('ascii')).hexdigest()
+            cached = preview_cache.get(cache_key)
+        if request.if_none_match.contains(cache_key):
+            return Response(status=304, headers={"ETag": f'"{cache_key}"'})
+        if cached is None:
+            with timer.stage('decode'):
+                preview_image, full_width, full_height = open_preview_image(_upload_stream(upload), max_size)
+            with timer.stage('composite'):
+                preview_image = render_preview(preview_image, full_width, full_height, **_visible_watermark_kwargs(options))
+            with timer.stage('save'):
+                byte_io = io.BytesIO()
+                save_image(preview_image, byte_io, 'JPEG', 'fastest')
+                cached = byte_io.getvalue()
+            preview_cache.put(cache_key, cached)
+            cache_status = "MISS"
+        else:
+            cache_status = "HIT"
+    except UnidentifiedImageError:
+        return jsonify({"error": "Cannot identify image file."}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = send_file(io.BytesIO(cached), mimetype='image/jpeg', etag=cache_key)
+    response.headers["X-Cache"] = cache_status
+    return response
+
+# --- Async Jobs ---
+
+class MemoryResultStore:
+    """Keeps job records and results in this process. Only suitable for a single server process."""
+
+    def __init__(self):
+        self._records = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def save_status(self, job_id, record):
+        with self._lock:
+            self._records[job_id] = dict(record)
+
+    def load_status(self, job_id):
+        with self._lock:
+            record = self._records.get(job_id)
+            return dict(record) if record is not None else None
+
+    def save_result(self, job_id, data):
+        with self._lock:
+            self._results[job_id] = bytes(data)
+
+    def load_result(self, job_id):
+        with self._lock:
+            return self._results.get(job_id)
+
+    def delete(self, job_id):
+        with self._lock:
+            self._records.pop(job_id, None)
+            self._results.pop(job_id, None)
+
+    def job_ids(self):
+        with self._lock:
+            return list(self._records)
+
+class FileSystemResultStore:
+    """
+    Keeps job records and results as files in a directory, so every server process
+    (e.g. the prefork workers) can answer status and result requests for any job.
+
+    Each job has '<id>.json' for its record and '<id>.result' for its output. Files are
+    written to a temporary name and renamed into place, so readers never see partial writes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.root, f"{job_id}{suffix}")
+
+    def save_status(self, job_id, record):
+        _write_file_atomic(self._path(job_id, '.json'), json.dumps(record).encode('utf-8'))
+
+    def load_status(self, job_id):
         try:
-            extracted_text = extracted_data_bytes.decode('utf-8')
-            print(f"DEBUG: Decoded as UTF-8: '{extracted_text[:100]}...'") # Add log
+            with open(self._path(job_id, '.json'), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
 
-            # Try to parse as JSON (for metadata structure)
-            try:
-                import json
-                metadata = json.loads(extracted_text)
-                print("DEBUG: Parsed as JSON successfully.") # Add log
-
-                if isinstance(metadata, dict) and "content" in metadata:
-                    content = metadata["content"] # Get the content
-                    watermark_type = metadata.get("watermark_type")
-                    print(f"DEBUG: Found metadata - type: {watermark_type}") # Add log
-
-                    if watermark_type == "text":
-                        extracted_string = str(content) if content is not None else ""
-                        print(f"DEBUG: Returning text content: '{extracted_string[:100]}...'") # Add log
-                        return jsonify({"extracted_text": extracted_string})
-
-                    elif watermark_type == "image":
-                        if isinstance(content, str):
-                            print("DEBUG: Returning image watermark data.") # Add log
-                            return jsonify({
-                                "extracted_text": "Image watermark detected",
-                                "is_image": True,
-                                "image_data": content
-                            })
-                        else:
-                            print("DEBUG: Returning image watermark with invalid content format.") # Add log
-                            return jsonify({
-                                "extracted_text": "Image watermark detected, but content data format is invalid.",
-                                "is_binary": True
-                            })
-                    else:
-                        # Known JSON structure but unknown watermark_type
-                        print(f"DEBUG: JSON parsed, but unknown watermark_type ('{watermark_type}'). Treating as plain text.") # Add log
-                        # Fall through to return the raw text (which is the JSON string itself)
-                        pass
+    def save_result(self, job_id, data):
+        _write_file_atomic(self._path(job_id, '.result'), data)
 
-                else:
-                     # JSON parsed, but not the expected dict structure with 'content'
-                     print("DEBUG: JSON parsed, but not the expected metadata structure. Treating as plain text.") # Add log
-                     # Fall through to return the raw text (which is the JSON string itself)
-                     pass
+    def load_result(self, job_id):
+        try:
+            with open(self._path(job_id, '.result'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def delete(self, job_id):
+        for suffix in ('.result', '.json'):
+            try: os.remove(self._path(job_id, suffix))
+            except OSError: pass
+
+    def job_ids(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        return [name[:-5] for name in names if name.endswith('.json') and not name.startswith('.')]
+
+class JobQueueFull(RuntimeError):
+    """Raised by JobManager.submit when the bounded job queue has no room."""
+
+class JobManager:
+    """
+    Runs watermark and extraction jobs on a local thread pool and records their progress in a result store.
+
+    At most `queue_size` jobs may be queued or running in this process at once; further
+    submissions raise JobQueueFull instead of growing an unbounded backlog. Finished jobs are
+    pruned from the store once they are older than `result_ttl` seconds.
+    """
+
+    PRUNE_INTERVAL = 60 # Seconds between scans of the store for expired jobs
 
+    def __init__(self, store, workers, queue_size, result_ttl):
+        self.store = store
+        self.queue_size = queue_size
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stegamark-job")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_prune = 0.0
+
+    def submit(self, job_type, fn, *args):
+        """
+        Queues fn(*args, progress) as a new job.
 
-            except (json.JSONDecodeError, TypeError) as json_err:
-                # Not valid JSON, treat as plain text
-                print(f"DEBUG: Not valid JSON ({json_err}). Returning as plain text.") # Add log
-                # Fall through to return the raw decoded text below
+        `fn` receives a progress(fraction, stage) callback as its last argument and returns
+        (result bytes, mimetype, download filename or None).
 
-            # --- Fall-through cases ---
-            # If JSON parsing failed OR it parsed but wasn't the expected structure/type,
-            # return the raw decoded text. The frontend should display this.
-            print(f"DEBUG: Falling through JSON handling. Returning raw decoded text: '{extracted_text[:100]}...'") # Add log
-            return jsonify({"extracted_text": extracted_text})
+        Returns:
+            dict: The new job record.
 
-        except UnicodeDecodeError:
-            # Handle non-UTF8 data
-            extracted_info = f"Extracted {len(extracted_data_bytes)} bytes (non-UTF8 data)"
-            print("DEBUG: Data is not valid UTF-8. Returning binary info.") # Add log
-            return jsonify({"extracted_text": extracted_info, "is_binary": True})
+        Raises:
+            JobQueueFull: If the queue is at capacity.
+        """
+        self._maybe_prune()
+        with self._lock:
+            if self._pending >= self.queue_size:
+                raise JobQueueFull(f"Job queue is full ({self.queue_size} jobs pending)")
+            self._pending += 1
+        record = {
+            "id": uuid.uuid4().hex, "type": job_type, "status": "queued", "progress": 0.0,
+            "stage": "queued", "error": None, "created_at": time.time(), "started_at": None,
+            "finished_at": None, "mimetype": None, "filename": None,
+        }
+        snapshot = dict(record) # The worker thread updates `record` from here on
+        try:
+            self.store.save_status(record["id"], record)
+            self._executor.submit(self._run, record, fn, args)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return snapshot
+
+    def _run(self, record, fn, args):
+        """Worker-thread body: runs one job and stores its result or error."""
+        def progress(fraction, stage):
+            record.update(progress=round(fraction, 3), stage=stage)
+            self.store.save_status(record["id"], record)
 
+        try:
+            record.update(status="running", started_at=time.time())
+            progress(0.0, 'open')
+            data, mimetype, filename = fn(*args, progress)
+            self.store.save_result(record["id"], data)
+            record.update(status="done", progress=1.0, stage="done", mimetype=mimetype, filename=filename)
+        except (ValueError, UnidentifiedImageError) as e:
+            record.update(status="failed", error=str(e))
+        except Exception as e:
+            print(f"Generic Exception in job {record['id']}: {e}", file=sys.stderr)
+            traceback.print_exc()
+            record.update(status="failed", error="An internal server error occurred while running the job.")
+        finally:
+            record["finished_at"] = time.time()
+            try:
+                self.store.save_status(record["id"], record)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+    def _maybe_prune(self):
+        """Deletes finished jobs older than result_ttl, at most once per PRUNE_INTERVAL."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+        for job_id in self.store.job_ids():
+            record = self.store.load_status(job_id)
+            if record and record.get("finished_at") and now - record["finished_at"] > self.result_ttl:
+                self.store.delete(job_id)
+
+# Job manager for /jobs, created on first use
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def _get_job_manager():
+    """Returns the process-wide JobManager, backed by a FileSystemResultStore in app.config['JOB_RESULT_DIR']."""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(FileSystemResultStore(app.config['JOB_RESULT_DIR']),
+                                      workers=app.config['JOB_WORKERS'],
+                                      queue_size=app.config['JOB_QUEUE_SIZE'],
+                                      result_ttl=app.config['JOB_RESULT_TTL'])
+        return _job_manager
+
+def _watermark_job(filename, image_bytes, options, progress):
+    """Job body for job_type 'watermark'."""
+    output_name, output_bytes = _watermark_batch_item(filename, image_bytes, options, progress)
+    return output_bytes, f"image/{os.path.splitext(output_name)[1][1:]}", output_name
+
+def _extract_job(image_bytes, strength, allow_legacy, key, progress):
+    """Job body for job_type 'extract'."""
+    try:
+        encoded_image = Image.open(_upload_stream(image_bytes))
+        encoded_image.load()
+    except UnidentifiedImageError:
+        raise ValueError("Cannot identify image file. Corrupted or unsupported?")
+    progress(0.2, 'detect' if strength is None else 'lsb')
+    try:
+        result = _run_extraction(encoded_image, strength, allow_legacy, key=key)
     except ValueError as e:
-        # Specific error from decode (delimiter not found)
-        error_message = (
-            f"{e}. Possible causes: "
-            "1) Incorrect 'Strength' setting (must match encoding strength). "
-            "2) Image was modified after encoding (e.g., re-saved, compressed, edited). "
-            "3) No watermark exists with the specified strength. "
-            "Please use the original, unmodified PNG file."
-        )
-        print(f"ERROR: ValueError during decode: {e}") # Add log
-        return jsonify({"error": error_message}), 400
-    except Exception as e:
-        print(f"ERROR: Unexpected error during extraction process: {e}", file=sys.stderr) # Add log
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": "An internal server error occurred during extraction."}), 500
+        raise ValueError(_extraction_error_message(e))
+    if result is None:
+        raise ValueError("No watermark detected at any strength. Please use the original, unmodified PNG file.")
+    return json.dumps(result).encode('utf-8'), 'application/json', None
+
+def _is_job_id(job_id):
+    """Job ids are uuid4 hex strings; anything else never reaches the store (and the filesystem)."""
+    return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+def _job_status_response(record):
+    """Public view of a job record, with the URLs to poll."""
+    response = {key: record[key] for key in ("id", "type", "status", "progress", "stage", "error",
+                                              "created_at", "started_at", "finished_at")}
+    response["status_url"] = f"/jobs/{record['id']}"
+    response["result_url"] = f"/jobs/{record['id']}/result"
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def handle_job_submit_request():
+    """
+    Flask route to run a watermark or extraction in the background.
+
+    Takes 'job_type' ('watermark' or 'extract') plus the same fields as /watermark or /extract,
+    and answers 202 with the job id and the URLs to poll, or 503 if the job queue is full.
+    """
+    job_type = request.form.get('job_type', 'watermark').lower()
+    if job_type not in ('watermark', 'extract'):
+        return jsonify({"error": "job_type must be 'watermark' or 'extract'"}), 400
+    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
+    image_file = request.files['image']
+    if image_file.filename == '': return jsonify({"error": "No selected image file"}), 400
+
+    try:
+        if job_type == 'watermark':
+            file_ext = os.path.splitext(image_file.filename)[1].lower()
+            if file_ext not in app.config['UPLOAD_EXTENSIONS']:
+                return jsonify({"error": f"Invalid image file type: {file_ext}"}), 400
+            # Read the upload now: Flask closes request files when the view returns
+            upload = _read_upload(image_file)
+            try:
+                image_size = Image.open(_upload_stream(upload)).size # Header only
+            except UnidentifiedImageError:
+                return jsonify({"error": "Cannot identify image file."}), 400
+            options = _parse_watermark_options(request.form, request.files, image_size)
+            job_args = (_watermark_job, image_file.filename, upload, options)
+        else:
+            strength_value = request.form.get('strength', '3').strip().lower()
+            strength = None
+            if strength_value != 'auto':
+                try:
+                    strength = int(strength_value)
+                except ValueError:
+                    return jsonify({"error": "Strength must be between 1 and 5 or 'auto'"}), 400
+                if not 1 <= strength <= 5:
+                    return jsonify({"error": "Strength must be between 1 and 5"}), 400
+            allow_legacy = request.form.get('legacy', 'true').lower() != 'false'
+            job_args = (_extract_job, _read_upload(image_file), strength, allow_legacy, request.form.get('key') or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnidentifiedImageError as e:
+        return jsonify({"error": f"Cannot identify logo file: {e}"}), 400
+
+    try:
+        record = _get_job_manager().submit(job_type, *job_args)
+    except JobQueueFull as e:
+        return jsonify({"error": f"{e}. Please retry later."}), 503, {"Retry-After": "5"}
+    return jsonify(_job_status_response(record)), 202, {"Location": f"/jobs/{record['id']}"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def handle_job_status_request(job_id):
+    """Flask route reporting the status and progress of a job."""
+    record = _get_job_manager().store.load_status(job_id) if _is_job_id(job_id) else None
+    if record is None: return jsonify({"error": "Unknown job id"}), 404
+    return jsonify(_job_status_response(record))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def handle_job_result_request(job_id):
+    """Flask route returning the output of a finished job: the watermarked image or the extraction JSON."""
+    store = _get_job_manager().store
+    record = store.load_status(job_id) if _is_job_id(job_id) else None
+    if record is None: return jsonify({"error": "Unknown job id"}), 404
+    if record["status"] == "failed": return jsonify({"error": record["error"]}), 422
+    if record["status"] != "done":
+        return jsonify({"error": f"Job is {record['status']}", "progress": record["progress"]}), 409
+    data = store.load_result(job_id)
+    if data is None: return jsonify({"error": "Job result has expired"}), 410
+    if record["filename"]:
+        return send_file(io.BytesIO(data), mimetype=record["mimetype"], as_attachment=True,
+                         download_name=record["filename"])
+    return Response(data, mimetype=record["mimetype"])
+
+# --- Benchmarking ---
+
+BENCH_RESOLUTIONS = ((640, 480), (1920, 1080), (4000, 3000))
+BENCH_TILE_STYLES = ('none', 'grid', 'staggered', 'diagonal')
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where the resource module is unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _time_case(fn, repeats):
+    """Runs fn once to warm up, then `repeats` times, returning the latencies in milliseconds."""
+    fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def _summarize_latencies(latencies, megapixels):
+    """Latency percentiles (ms), throughput (MP/s) and peak RSS for one benchmark case."""
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    mean = float(np.mean(latencies))
+    return {
+        "p50_ms": round(float(p50), 3), "p90_ms": round(float(p90), 3), "p99_ms": round(float(p99), 3),
+        "mean_ms": round(mean, 3),
+        "mp_per_s": round(megapixels / (mean / 1000), 3) if mean > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+def run_benchmarks(resolutions=BENCH_RESOLUTIONS, strengths=range(1, 6), tile_styles=BENCH_TILE_STYLES,
+                   repeats=5, payload_size=1024, seed=0, log=None):
+    """
+    Benchmarks LSB encode/decode and visible watermarking on synthetic images.
+
+    Args:
+        resolutions (iterable): (width, height) pairs to generate random RGB images at.
+        strengths (iterable): LSB strengths to run encode_image/decode_image with.
+        tile_styles (iterable): Tile styles to run add_visible_watermark with.
+        repeats (int): Timed runs per case (after one warm-up run).
+        payload_size (int): Bytes hidden per LSB encode (capped to the image capacity).
+        seed (int): Seed for the synthetic images and payload.
+        log (callable, optional): Called with a progress line per finished case.
+
+    Returns:
+        dict: {"meta": {...}, "results": {case name: stats}}, JSON-serializable.
+              Case names look like 'encode/1920x1080/s3', 'decode/...' and 'visible/1920x1080/grid'.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    for width, height in resolutions:
+        image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+        megapixels = width * height / 1e6
+        size_label = f"{width}x{height}"
+
+        cases = []
+        for strength in strengths:
+            steg = LSBSteganography(strength)
+            payload = rng.integers(0, 256, min(payload_size, steg._get_max_bytes(image)), dtype=np.uint8).tobytes()
+            encoded = steg.encode_image(image, payload)
+            cases.append((f"encode/{size_label}/s{strength}", lambda s=steg, p=payload: s.encode_image(image, p)))
+            cases.append((f"decode/{size_label}/s{strength}", lambda s=steg, e=encoded: s.decode_image(e)))
+        for tile_style in tile_styles:
+            cases.append((f"visible/{size_label}/{tile_style}",
+                          lambda t=tile_style: add_visible_watermark(image, text="© StegaMark", tile_style=t)))
+
+        for name, fn in cases:
+            results[name] = _summarize_latencies(_time_case(fn, repeats), megapixels)
+            if log:
+                stats = results[name]
+                log(f"{name:<28} p50 {stats['p50_ms']:>10.2f} ms  p90 {stats['p90_ms']:>10.2f} ms  "
+                    f"{stats['mp_per_s'] or 0:>8.2f} MP/s")
+
+    meta = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": sys.version.split()[0], "numpy": np.__version__, "pillow": Image.__version__,
+        "platform": sys.platform, "cpu_count": os.cpu_count(),
+        "repeats": repeats, "payload_size": payload_size,
+    }
+    return {"meta": meta, "results": results}
+
+def compare_benchmarks(current, baseline, threshold=0.10, metric="p50_ms"):
+    """
+    Compares benchmark results against a saved baseline.
+
+    Args:
+        current (dict): Results from run_benchmarks.
+        baseline (dict): Earlier results from run_benchmarks.
+        threshold (float): Allowed slowdown as a fraction, e.g. 0.10 = 10% slower.
+        metric (str): Latency statistic to compare.
+
+    Returns:
+        list: (case name, baseline value, current value, ratio) for every case slower than allowed,
+              considering only cases present in both result sets.
+    """
+    regressions = []
+    for name, stats in current["results"].items():
+        base_stats = baseline.get("results", {}).get(name)
+        if not base_stats or not base_stats.get(metric):
+            continue
+        ratio = stats[metric] / base_stats[metric]
+        if ratio > 1 + threshold:
+            regressions.append((name, base_stats[metric], stats[metric], ratio))
+    return regressions
+
+def run_output_benchmarks(image, formats=("PNG", "JPEG", "WEBP"), profiles=tuple(OUTPUT_PROFILES), repeats=3, log=None):
+    """
+    Measures encode time against output size for every output profile on one image.
+
+    Args:
+        image (Image.Image): The image to encode, e.g. a typical watermarked result.
+        formats (iterable): Output formats to try. WEBP is skipped if Pillow lacks WebP support.
+        profiles (iterable): Names from OUTPUT_PROFILES.
+        repeats (int): Timed runs per case (after one warm-up run).
+        log (callable, optional): Called with a progress line per finished case.
+
+    Returns:
+        dict: {"meta": {...}, "results": {case name: stats}}, JSON-serializable. Case names look like
+              'PNG/fastest'; stats are those of run_benchmarks plus "bytes" and "bits_per_pixel".
+    """
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB") # Palette/grayscale inputs, as watermarking outputs
+    image.load()
+    width, height = image.size
+    megapixels = width * height / 1e6
+    results = {}
+    for output_format in formats:
+        if output_format == "WEBP" and not features.check("webp"):
+            continue
+        for profile in profiles:
+            def encode():
+                output = io.BytesIO()
+                save_image(image, output, output_format, profile)
+                return output.tell()
+            name = f"{output_format}/{profile}"
+            stats = _summarize_latencies(_time_case(encode, repeats), megapixels)
+            stats["bytes"] = encode()
+            stats["bits_per_pixel"] = round(stats["bytes"] * 8 / max(1, width * height), 3)
+            results[name] = stats
+            if log:
+                log(f"{name:<16} p50 {stats['p50_ms']:>10.2f} ms  {stats['bytes']:>12,} bytes  "
+                    f"{stats['bits_per_pixel']:>7.3f} bpp")
+
+    meta = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": sys.version.split()[0], "pillow": Image.__version__,
+        "platform": sys.platform, "image": f"{width}x{height} {image.mode}", "repeats": repeats,
+    }
+    return {"meta": meta, "results": results}
 
 # --- Command Line Interface Functions (Updated) ---
 
+def _load_cli_logo(logo_path):
+    """Loads the --logo image for visible watermarking, returning None (with a warning) if it cannot be read."""
+    try:
+        logo_img = Image.open(logo_path)
+        print(f"Loaded logo from {logo_path}")
+        return logo_img
+    except FileNotFoundError:
+        print(f"Warning: Logo file not found: {logo_path}", file=sys.stderr)
+    except UnidentifiedImageError:
+        print(f"Warning: Cannot identify logo file: {logo_path}", file=sys.stderr)
+    except Exception as e:
+        print(f"Warning: Error loading logo: {e}", file=sys.stderr)
+    print("Continuing with text-only watermark")
+    return None
+
+def _encode_visible_file(input_path, output_path, text=None, logo_image=None, position="center", opacity=0.5, threads=1,
+                         profile="balanced"):
+    """Adds a visible watermark to an image file and saves it. JPEG inputs stay JPEG, everything else becomes PNG."""
+    base_image = Image.open(input_path)
+    result_image = add_visible_watermark(
+        base_image,
+        text=text,
+        logo_image=logo_image,
+        position=position,
+        opacity=opacity,
+        threads=threads,
+        # Add args for font_path, font_size, text_color if needed
+    )
+    # Determine output format (keep original if JPEG?)
+    output_format = "PNG" # Default safe choice
+    if base_image.format and base_image.format.upper() in ['JPEG', 'JPG']:
+        output_format = 'JPEG'
+    save_image(result_image, output_path, output_format, profile)
+
 def cli_encode_visible(args):
     print("Encoding visible watermark via CLI")
     try:
-        base_image = Image.open(args.input)
         logo_img = None
-        
         # Add logic to load logo if --logo path is provided
         if hasattr(args, 'logo') and args.logo:
-            try:
-                logo_img = Image.open(args.logo)
-                print(f"Loaded logo from {args.logo}")
-            except FileNotFoundError:
-                print(f"Warning: Logo file not found: {args.logo}", file=sys.stderr)
-                print("Continuing with text-only watermark")
-            except UnidentifiedImageError:
-                print(f"Warning: Cannot identify logo file: {args.logo}", file=sys.stderr)
-                print("Continuing with text-only watermark")
-            except Exception as e:
-                print(f"Warning: Error loading logo: {e}", file=sys.stderr)
-                print("Continuing with text-only watermark")
-
-        result_image = add_visible_watermark(
-            base_image,
-            text=args.text,
-            logo_image=logo_img,
-            position=args.position,
-            opacity=args.opacity,
-            # Add args for font_path, font_size, text_color if needed
-        )
-        # Determine output format (keep original if JPEG?)
-        output_format = "PNG" # Default safe choice
-        if base_image.format and base_image.format.upper() in ['JPEG', 'JPG']:
-            output_format = 'JPEG'
-            if result_image.mode == 'RGBA': result_image = result_image.convert('RGB')
-
-        save_kwargs = {'quality': 95} if output_format == 'JPEG' else {}
-        result_image.save(args.output, format=output_format, **save_kwargs)
+            logo_img = _load_cli_logo(args.logo)
+
+        _encode_visible_file(args.input, args.output, text=args.text, logo_image=logo_img,
+                             position=args.position, opacity=args.opacity, threads=args.threads,
+                             profile=args.output_profile)
         print(f"Visible watermark added and saved to {args.output}")
 
     except FileNotFoundError as e:
@@ -794,17 +2959,14 @@ def cli_encode_visible(args):
         sys.exit(1)
 
 
-def cli_encode_invisible(args):
-    print("Encoding invisible watermark using LSB steganography via CLI")
-
-    # Read the secret data as bytes
-    secret_data = None
+def _load_cli_secret_data(args):
+    """Reads the secret data (--message or --file) as bytes, exiting with an error if neither is usable."""
     if args.message:
-        secret_data = args.message.encode('utf-8')
+        return args.message.encode('utf-8')
     elif args.file:
         try:
             with open(args.file, 'rb') as f:
-                secret_data = f.read()
+                return f.read()
         except FileNotFoundError:
              print(f"Error: Secret data file not found: {args.file}", file=sys.stderr)
              sys.exit(1)
@@ -815,15 +2977,28 @@ def cli_encode_invisible(args):
         print("Error: Either --message or --file must be specified for invisible encoding", file=sys.stderr)
         sys.exit(1)
 
-    if not args.output.lower().endswith(".png"):
+def cli_encode_invisible(args):
+    print("Encoding invisible watermark using LSB steganography via CLI")
+
+    # Read the secret data as bytes
+    secret_data = _load_cli_secret_data(args)
+
+    if not args.output.lower().endswith((".png", ".webp")):
         print("Warning: Output file for LSB encoding should ideally be .png to ensure data preservation.", file=sys.stderr)
         # Continue anyway, but warn user
+    output_format = "WEBP" if args.output.lower().endswith(".webp") else "PNG" # Lossless WebP on request
 
-    steg = LSBSteganography(args.strength)
+    format_version = LSBSteganography.FORMAT_LEGACY if args.legacy_format else LSBSteganography.FORMAT_V2
+    try:
+        steg = LSBSteganography(args.strength, format_version=format_version, compression=args.compression, key=args.key,
+                                threads=args.threads)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
     try:
         base_image = Image.open(args.input)
         encoded_image = steg.encode_image(base_image, secret_data)
-        encoded_image.save(args.output, "PNG") # Force PNG for saving LSB
+        save_image(encoded_image, args.output, output_format, args.output_profile) # Force PNG (or lossless WebP) for LSB
         print(f"Successfully encoded data into {args.output}")
     except FileNotFoundError:
         print(f"Error: Input image file not found: {args.input}", file=sys.stderr)
@@ -838,12 +3013,38 @@ def cli_encode_invisible(args):
         print(f"An unexpected error occurred during encoding: {e}", file=sys.stderr)
         sys.exit(1)
 
+def _decode_image_file(input_path, strength=3, allow_legacy=True, key=None, threads=1):
+    """
+    Extracts hidden data from an image file.
+
+    Args:
+        input_path (str): Path of the watermarked image.
+        strength (int | str): Decoding strength (1-5) or 'auto' to detect it.
+        allow_legacy (bool): Fall back to the legacy delimiter scan for images without a v2 header.
+        key (str, optional): Key of a keyed watermark.
+        threads (int): Threads that decode the image.
+
+    Returns:
+        tuple: (extracted bytes, strength used)
+    """
+    encoded_image = Image.open(input_path)
+    if strength == 'auto':
+        strength = LSBSteganography.detect_strength(encoded_image, key=key, threads=threads)
+        if strength is None:
+            raise ValueError("No watermark detected at any strength")
+    steg = LSBSteganography(strength, key=key, threads=threads)
+    return steg.decode_image(encoded_image, allow_legacy=allow_legacy), strength
+
 def cli_decode(args):
     print("Decoding hidden data from image via CLI")
-    steg = LSBSteganography(args.strength)
     try:
-        encoded_image = Image.open(args.input)
-        extracted_data = steg.decode_image(encoded_image)
+        extracted_data, strength = _decode_image_file(args.input, args.strength, args.allow_legacy, args.key, args.threads)
+        if args.strength == 'auto':
+            print(f"Detected strength: {strength}")
+        payload = unpack_payload(extracted_data)
+        if payload is not None: # Written by the web app: output the text or image it holds
+            print(f"Payload container: {payload['watermark_type']} {payload['format']}".rstrip())
+            extracted_data = payload["content"]
 
         if args.output:
             # Write to file in binary mode
@@ -879,17 +3080,474 @@ def cli_decode(args):
         print(f"An unexpected error occurred during decoding: {e}", file=sys.stderr)
         sys.exit(1)
 
+def cli_capacity(args):
+    try:
+        image = Image.open(args.input) # Reads only the header
+    except FileNotFoundError:
+        print(f"Error: Input image file not found: {args.input}", file=sys.stderr)
+        sys.exit(1)
+    except UnidentifiedImageError:
+        print(f"Error: Cannot identify input image file: {args.input}", file=sys.stderr)
+        sys.exit(1)
+    payload = _load_cli_secret_data(args) if (args.message or args.file) else None
+    report = capacity_report(image.width, image.height, payload, args.compression)
+
+    if args.json:
+        report.update(mode=image.mode, format=image.format)
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Capacity of {args.input} ({image.width}x{image.height} {image.format or ''} {image.mode}):")
+    if payload is not None:
+        info = report["payload"]
+        print(f"Payload: {info['bytes']} bytes, {info['compressed_bytes']} bytes with {info['codec']} compression")
+    for entry in report["capacity"]:
+        line = f"  strength {entry['strength']} ({entry['lsb_bits']} LSB bits): {entry['max_bytes']:>12,} bytes"
+        if payload is not None:
+            line += f"  fits: {'yes' if entry['fits'] else 'no'}, compressed: {'yes' if entry['fits_compressed'] else 'no'}"
+        print(line)
+
+# --- Batch Processing (CLI) ---
+
+# Per-process state of batch workers (logo, secret data, ...), set up once by _init_batch_worker
+_batch_worker_state = {}
+
+def _collect_batch_inputs(input_spec):
+    """Returns the sorted image files in a directory, or matching a glob pattern."""
+    if os.path.isdir(input_spec):
+        candidates = [os.path.join(input_spec, name) for name in os.listdir(input_spec)]
+    else:
+        candidates = glob.glob(input_spec)
+    return sorted(path for path in candidates
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in app.config['UPLOAD_EXTENSIONS'])
+
+def _batch_output_path(operation, input_path, output_dir, profile="balanced"):
+    """Output path for one batch item: JPEGs stay JPEG for visible marks, LSB outputs are PNG (or WebP), decodes are .bin."""
+    stem, ext = os.path.splitext(os.path.basename(input_path))
+    if operation == 'visible':
+        out_ext = '.jpg' if ext.lower() in ('.jpg', '.jpeg') else '.png'
+    elif operation == 'invisible':
+        out_ext = '.' + lsb_output_format(profile).lower()
+    else:
+        out_ext = '.bin'
+    return os.path.join(output_dir, stem + out_ext)
+
+def _batch_output_paths(operation, input_paths, output_dir, profile="balanced"):
+    """
+    Output paths for a whole batch, without collisions.
+
+    Inputs that would share an output (e.g. photo.jpg and photo.png both becoming photo.png)
+    keep their source extension instead (photo.jpg.png, photo.png.png). The names only depend
+    on the set of inputs, so reruns find the outputs of earlier runs.
+
+    Returns:
+        list: One output path per input path, in the same order.
+    """
+    paths = [_batch_output_path(operation, input_path, output_dir, profile) for input_path in input_paths]
+    counts = {}
+    for path in paths:
+        counts[path] = counts.get(path, 0) + 1
+    for i, input_path in enumerate(input_paths):
+        if counts[paths[i]] > 1:
+            paths[i] = os.path.join(output_dir, os.path.basename(input_path) + os.path.splitext(paths[i])[1])
+    used = set()
+    for i, path in enumerate(paths):
+        base_name, ext = os.path.splitext(path)
+        counter = 1
+        while path in used: # Still taken, e.g. by an input literally named photo.jpg.png
+            path = f"{base_name}_{counter}{ext}"
+            counter += 1
+        used.add(path)
+        paths[i] = path
+    return paths
+
+def _init_batch_worker(operation, options):
+    """Process pool initializer: prepares the state shared by every item a worker handles."""
+    _batch_worker_state.clear()
+    _batch_worker_state.update(operation=operation, options=options)
+    if operation == 'visible' and options.get('logo'):
+        _batch_worker_state['logo_image'] = _load_cli_logo(options['logo'])
+    elif operation == 'invisible':
+        _batch_worker_state['plan'] = options['plan'] # Prepared once by the parent for every image
+
+def _run_batch_item(paths):
+    """
+    Processes one (input_path, output_path) pair in a batch worker.
+
+    If output_path is None the result is returned instead of written, for streaming into an archive.
+
+    Returns:
+        tuple: (input_path, input size in bytes, error message or None, result bytes or None)
+    """
+    input_path, output_path = paths
+    operation = _batch_worker_state['operation']
+    options = _batch_worker_state['options']
+    try:
+        output = io.BytesIO()
+        if operation == 'visible':
+            _encode_visible_file(input_path, output, text=options['text'],
+                                 logo_image=_batch_worker_state.get('logo_image'),
+                                 position=options['position'], opacity=options['opacity'],
+                                 profile=options['output_profile'])
+        elif operation == 'invisible':
+            encoded_image = _batch_worker_state['plan'].apply(Image.open(input_path))
+            save_image(encoded_image, output, lsb_output_format(options['output_profile']), options['output_profile'])
+        else:
+            extracted_data, _ = _decode_image_file(input_path, options['strength'], options['allow_legacy'], options['key'])
+            payload = unpack_payload(extracted_data) # Web app payloads are saved as the text or image they hold
+            output.write(payload["content"] if payload is not None else extracted_data)
+
+        if output_path is None:
+            return input_path, os.path.getsize(input_path), None, output.getvalue()
+        with open(output_path, 'wb') as f:
+            f.write(output.getbuffer())
+        return input_path, os.path.getsize(input_path), None, None
+    except Exception as e:
+        return input_path, 0, f"{type(e).__name__}: {e}", None
+
+def _run_batch(operation, args, options):
+    """
+    Fans a batch out over a process pool and prints a throughput summary. Exits with 1 if any item failed.
+
+    Results go into args.output_dir, or are streamed into a ZIP archive if it ends with '.zip'.
+    """
+    input_paths = _collect_batch_inputs(args.input)
+    if not input_paths:
+        print(f"Error: No input images found for '{args.input}'", file=sys.stderr)
+        sys.exit(1)
+
+    to_archive = args.output_dir.lower().endswith('.zip')
+    jobs = []
+    skipped = 0
+    if to_archive:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_dir)), exist_ok=True)
+        jobs = [(input_path, None) for input_path in input_paths]
+        # Archive member name of each input, deduplicated like output files
+        archive_names = dict(zip(input_paths, _batch_output_paths(operation, input_paths, '', options.get('output_profile'))))
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_paths = _batch_output_paths(operation, input_paths, args.output_dir, options.get('output_profile'))
+        for input_path, output_path in zip(input_paths, output_paths):
+            if not args.overwrite and os.path.exists(output_path):
+                skipped += 1 # Already done by a previous run
+                continue
+            jobs.append((input_path, output_path))
+
+    workers = max(1, args.workers or os.cpu_count() or 1)
+    print(f"Processing {len(jobs)} image(s) with {workers} worker(s), {skipped} already done.")
+
+    failures = []
+    processed = 0
+    bytes_in = 0
+    start_time = time.perf_counter()
+    if workers == 1:
+        _init_batch_worker(operation, options)
+        results = map(_run_batch_item, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                       initargs=(operation, options))
+        if to_archive:
+            # Bound the finished results waiting to be written to the archive
+            results = (future.result() for future in iter_bounded(executor, _run_batch_item, jobs, workers * 2))
+        else:
+            chunksize = max(1, min(64, len(jobs) // (workers * 4)))
+            results = executor.map(_run_batch_item, jobs, chunksize=chunksize)
+
+    def archive_entries():
+        nonlocal processed, bytes_in
+        for input_path, size, error, data in results:
+            if error:
+                failures.append((input_path, error))
+                print(f"Failed: {input_path}: {error}", file=sys.stderr)
+                continue
+            processed += 1
+            bytes_in += size
+            if data is not None:
+                yield archive_names[input_path], data
+
+    try:
+        if to_archive:
+            with open(args.output_dir, 'wb') as archive_file:
+                for chunk in iter_zip_stream(archive_entries()):
+                    archive_file.write(chunk)
+        else:
+            for _ in archive_entries():
+                pass
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    elapsed = time.perf_counter() - start_time
+
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    mb_rate = bytes_in / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    print("--- Batch Summary ---")
+    print(f"Processed: {processed}, Skipped: {skipped}, Failed: {len(failures)}")
+    print(f"Elapsed: {elapsed:.2f}s, Throughput: {rate:.2f} images/s, {mb_rate:.2f} MB/s")
+    if to_archive:
+        print(f"Results written to archive {args.output_dir}")
+    if failures:
+        sys.exit(1)
+
+def cli_batch_visible(args):
+    print("Batch encoding visible watermarks via CLI")
+    options = {'text': args.text, 'logo': args.logo, 'position': args.position, 'opacity': args.opacity,
+               'output_profile': args.output_profile}
+    _run_batch('visible', args, options)
+
+def cli_batch_invisible(args):
+    print("Batch encoding invisible watermarks using LSB steganography via CLI")
+    if args.legacy_format and (args.compression != 'none' or args.key):
+        print("Error: Payload compression and --key require the v2 payload format (drop --legacy-format).", file=sys.stderr)
+        sys.exit(1)
+    format_version = LSBSteganography.FORMAT_LEGACY if args.legacy_format else LSBSteganography.FORMAT_V2
+    try:
+        steg = LSBSteganography(args.strength, format_version=format_version, compression=args.compression, key=args.key)
+        # Compression, header and bit groups are computed once here instead of once per image
+        options = {'plan': steg.prepare(_load_cli_secret_data(args)), 'output_profile': args.output_profile}
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    _run_batch('invisible', args, options)
+
+def cli_batch_decode(args):
+    print("Batch decoding hidden data via CLI")
+    options = {'strength': args.strength, 'allow_legacy': args.allow_legacy, 'key': args.key}
+    _run_batch('decode', args, options)
+
+def _resolution_arg(value):
+    """argparse type for benchmark resolutions: a comma-separated list like '640x480,1920x1080'."""
+    try:
+        resolutions = []
+        for part in value.split(','):
+            width, height = part.lower().split('x')
+            resolutions.append((int(width), int(height)))
+        return resolutions
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid resolutions: '{value}' (expected e.g. 640x480,1920x1080)")
+
+def cli_bench(args):
+    print("Running StegaMark benchmarks")
+    results = run_benchmarks(resolutions=args.resolutions, repeats=args.repeats,
+                             payload_size=args.payload_size, log=print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"Error reading baseline {args.baseline}: {e}", file=sys.stderr)
+            sys.exit(1)
+        regressions = compare_benchmarks(results, baseline, threshold=args.threshold)
+        if regressions:
+            print(f"--- {len(regressions)} regression(s) over {args.threshold:.0%} (p50) ---")
+            for name, before, after, ratio in regressions:
+                print(f"{name:<28} {before:>10.2f} ms -> {after:>10.2f} ms  ({ratio:.2f}x)")
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}")
+
+def cli_bench_output(args):
+    print("Benchmarking output encoding profiles")
+    try:
+        image = Image.open(args.input)
+        if args.strength:
+            # Time what an invisible watermark result looks like: LSBs filled with payload noise
+            steg = LSBSteganography(args.strength)
+            image = steg.encode_image(image, os.urandom(steg._get_max_bytes(image)))
+    except FileNotFoundError:
+        print(f"Error: Input image file not found: {args.input}", file=sys.stderr)
+        sys.exit(1)
+    except UnidentifiedImageError:
+        print(f"Error: Cannot identify input image file: {args.input}", file=sys.stderr)
+        sys.exit(1)
+
+    results = run_output_benchmarks(image, formats=args.formats, repeats=args.repeats, log=print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+# --- Production Server (Prefork + Thread Pool) ---
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    werkzeug WSGI server that handles connections on a fixed-size thread pool.
+
+    At most `threads` requests run at once and `queue_size` more wait for a thread; beyond that
+    the server stops accepting and new connections wait in the listen backlog. After
+    `max_requests` requests (0 = unlimited) the server shuts itself down so it can be recycled.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, wsgi_app, threads=4, queue_size=16, max_requests=0, fd=None):
+        super().__init__(host, port, wsgi_app, fd=fd)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="stegamark-http")
+        self._slots = threading.BoundedSemaphore(threads + queue_size)
+        self._count_lock = threading.Lock()
+        self.max_requests = max_requests
+        self.requests_handled = 0
+
+    def process_request(self, request, client_address):
+        self._slots.acquire() # Blocks accepting while the pool and its queue are full
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+            with self._count_lock:
+                self.requests_handled += 1
+                recycle = self.max_requests and self.requests_handled == self.max_requests
+            if recycle:
+                print(f"Worker {os.getpid()} handled {self.requests_handled} requests, recycling.", file=sys.stderr)
+                self.request_shutdown()
+
+    def request_shutdown(self):
+        """Stops accepting connections; serve_forever returns once the listener loop notices."""
+        threading.Thread(target=self.shutdown, daemon=True).start() # shutdown() blocks, so never call it inline
+
+    def drain(self):
+        """Waits for in-flight requests to finish and releases the pool."""
+        self._pool.shutdown(wait=True)
+
+def _serve_worker(listen_fd, host, port, threads, queue_size, max_requests):
+    """Runs one server worker on the shared listening socket until it is stopped or recycled."""
+    server = PooledWSGIServer(host, port, app, threads=threads, queue_size=queue_size,
+                              max_requests=max_requests, fd=listen_fd)
+    stop = lambda signum, frame: server.request_shutdown()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.drain() # Graceful: let accepted requests complete
+        server.server_close()
+
+def run_prefork_server(host='0.0.0.0', port=5000, workers=2, threads=4, queue_size=16, backlog=128,
+                       max_requests=0, graceful_timeout=30):
+    """
+    Serves the app from `workers` forked processes sharing one listening socket.
+
+    Each worker runs a PooledWSGIServer with `threads` request threads. Workers that exit (crash or
+    recycling after `max_requests`) are replaced. SIGTERM/SIGINT stops accepting, lets workers finish
+    in-flight requests for up to `graceful_timeout` seconds, then kills what is left.
+    On platforms without os.fork a single in-process worker is used.
+    """
+    listen_socket = socket.create_server((host, port), backlog=backlog)
+    listen_socket.set_inheritable(True)
+    print(f"Listening on http://{host}:{port} with {workers} worker(s) x {threads} thread(s)")
+
+    if not hasattr(os, 'fork'):
+        print("Warning: os.fork is unavailable on this platform; running a single worker.", file=sys.stderr)
+        _serve_worker(listen_socket.fileno(), host, port, threads, queue_size, max_requests)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0: # Child
+            exit_code = 0
+            try:
+                _serve_worker(listen_socket.fileno(), host, port, threads, queue_size, max_requests)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children.add(pid)
+
+    def kill_remaining():
+        for pid in list(children):
+            try: os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError: pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        print("Shutting down: waiting for in-flight requests...", file=sys.stderr)
+        for pid in list(children):
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+        killer = threading.Timer(graceful_timeout, kill_remaining)
+        killer.daemon = True
+        killer.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn_worker()
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            spawn_worker() # Replace a crashed or recycled worker
+    listen_socket.close()
+    print("Server stopped.")
+
 def run_web_server(args):
-     """Starts the Flask web server."""
+     """Starts the Flask web server (development server, or the prefork server with --workers)."""
+     if args.workers:
+         print("Starting StegaMark production server...")
+         run_prefork_server(host=args.host, port=args.port, workers=args.workers, threads=args.threads,
+                            queue_size=args.queue_size, backlog=args.backlog,
+                            max_requests=args.max_requests, graceful_timeout=args.graceful_timeout)
+         return
      print("Starting Flask web server...")
      # Use host='0.0.0.0' to make it accessible on the network
      # Use debug=True only for development
      is_debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
-     app.run(host='0.0.0.0', port=5000, debug=is_debug)
+     app.run(host=args.host, port=args.port, debug=is_debug)
 
 
 # --- Main Execution & CLI Parser ---
 
+def _strength_arg(value):
+    """argparse type for decoding strength: an integer 1-5 or 'auto'."""
+    if value.lower() == 'auto':
+        return 'auto'
+    try:
+        strength = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid strength: '{value}' (choose from 1-5 or 'auto')")
+    if not 1 <= strength <= 5:
+        raise argparse.ArgumentTypeError(f"invalid strength: {strength} (choose from 1-5 or 'auto')")
+    return strength
+
+def _threads_arg(value):
+    """argparse type for --threads: a positive integer."""
+    try:
+        threads = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid thread count: '{value}'")
+    if threads < 1:
+        raise argparse.ArgumentTypeError(f"invalid thread count: {threads} (must be at least 1)")
+    return threads
+
+def _output_formats_arg(value):
+    """argparse type for --formats: comma-separated output formats out of PNG, JPEG and WEBP."""
+    formats = [name.strip().upper() for name in value.split(',') if name.strip()]
+    for name in formats:
+        if name not in ("PNG", "JPEG", "WEBP"):
+            raise argparse.ArgumentTypeError(f"invalid output format: '{name}' (choose from PNG, JPEG, WEBP)")
+    return formats
+
 def main():
     parser = argparse.ArgumentParser(
         description="StegaMark - Image Watermarking Tool (CLI & Web)",
@@ -910,6 +3568,10 @@ def main():
                                 help="Position of watermark (default: '%(default)s').")
     visible_parser.add_argument("--opacity", type=float, default=0.5,
                                 help="Watermark opacity (0.0=transparent, 1.0=opaque, default: %(default)s).")
+    visible_parser.add_argument("--threads", type=_threads_arg, default=1,
+                                help="Threads compositing bands of the image (default: %(default)s).")
+    visible_parser.add_argument("--output-profile", default="balanced", choices=list(OUTPUT_PROFILES),
+                                help="Encoder settings for the output image (default: %(default)s).")
     visible_parser.set_defaults(func=cli_encode_visible)
 
     # --- Invisible watermark arguments ---
@@ -920,18 +3582,133 @@ def main():
     invisible_parser.add_argument("--file", help="Path to file containing data to encode.")
     invisible_parser.add_argument("--strength", type=int, default=3, choices=range(1, 6),
                                 help="Encoding strength (1-5). Higher values use more bits. Default: %(default)s")
+    invisible_parser.add_argument("--legacy-format", action="store_true",
+                                help="Write the old delimiter-terminated format instead of the v2 header format.")
+    invisible_parser.add_argument("--compression", default="none", choices=["auto"] + available_codecs(),
+                                help="Compress the payload before embedding; 'auto' keeps the smallest result. Default: %(default)s")
+    invisible_parser.add_argument("--key", help="Secret key: scatter the watermark over the whole image in a keyed order.\n"
+                                               "The same key is needed to decode it.")
+    invisible_parser.add_argument("--threads", type=_threads_arg, default=1,
+                                help="Threads encoding bands of the image (default: %(default)s).")
+    invisible_parser.add_argument("--output-profile", default="balanced", choices=list(OUTPUT_PROFILES),
+                                help="Encoder settings for the output image (default: %(default)s).\n"
+                                     "Name the output .webp to write lossless WebP instead of PNG.")
     invisible_parser.set_defaults(func=cli_encode_invisible)
 
     # --- Decode watermark arguments ---
     decode_parser = subparsers.add_parser("decode", help="Extract hidden data from watermarked image.")
     decode_parser.add_argument("input", help="Input watermarked image file path.")
     decode_parser.add_argument("--output", help="Output file path for extracted data. If omitted, displays as text.")
-    decode_parser.add_argument("--strength", type=int, default=3, choices=range(1, 6),
-                              help="Decoding strength (1-5). Must match encoding strength. Default: %(default)s")
+    decode_parser.add_argument("--strength", type=_strength_arg, default=3,
+                              help="Decoding strength (1-5) or 'auto' to detect it. Must match encoding strength. Default: %(default)s")
+    decode_parser.add_argument("--no-legacy", dest="allow_legacy", action="store_false",
+                              help="Only accept v2 header images; skip the full-image scan for the legacy delimiter.")
+    decode_parser.add_argument("--key", help="Key the watermark was embedded with, if any.")
+    decode_parser.add_argument("--threads", type=_threads_arg, default=1,
+                              help="Threads decoding bands of the image (default: %(default)s).")
     decode_parser.set_defaults(func=cli_decode)
 
+    # --- Capacity report arguments ---
+    capacity_parser = subparsers.add_parser("capacity", help="Report invisible watermark capacity per strength (reads only the image header).")
+    capacity_parser.add_argument("input", help="Input image file path.")
+    capacity_parser.add_argument("--message", help="Secret text message to check against the capacity.")
+    capacity_parser.add_argument("--file", help="Path to file containing data to check against the capacity.")
+    capacity_parser.add_argument("--compression", default="auto", choices=["auto"] + available_codecs(),
+                                 help="Codec for the compressed payload size. Default: %(default)s")
+    capacity_parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    capacity_parser.set_defaults(func=cli_capacity)
+
+    # --- Batch arguments (directory or glob in, directory out) ---
+    def add_batch_arguments(batch_parser):
+        batch_parser.add_argument("input", help="Input directory, or a glob pattern such as 'photos/*.jpg' (quote it).")
+        batch_parser.add_argument("output_dir", help="Directory to write results into (created if missing),\n"
+                                                     "or a .zip file to stream them into.")
+        batch_parser.add_argument("--workers", type=int, default=None,
+                                  help="Number of worker processes (default: number of CPUs).")
+        batch_parser.add_argument("--overwrite", action="store_true",
+                                  help="Reprocess images whose output already exists (default: skip them).\n"
+                                       "Archives are always rebuilt.")
+
+    batch_visible_parser = subparsers.add_parser("batch-visible", help="Add visible watermarks to many images.")
+    add_batch_arguments(batch_visible_parser)
+    batch_visible_parser.add_argument("--text", default="© StegaMark", help="Watermark text (default: '%(default)s').")
+    batch_visible_parser.add_argument("--logo", help="Path to logo image file for visible watermark.")
+    batch_visible_parser.add_argument("--position", default="center",
+                                      choices=["top-left", "top-center", "top-right",
+                                               "center-left", "center", "center-right",
+                                               "bottom-left", "bottom-center", "bottom-right"],
+                                      help="Position of watermark (default: '%(default)s').")
+    batch_visible_parser.add_argument("--opacity", type=float, default=0.5,
+                                      help="Watermark opacity (0.0=transparent, 1.0=opaque, default: %(default)s).")
+    batch_visible_parser.add_argument("--output-profile", default="balanced", choices=list(OUTPUT_PROFILES),
+                                      help="Encoder settings for the output images (default: %(default)s).")
+    batch_visible_parser.set_defaults(func=cli_batch_visible)
+
+    batch_invisible_parser = subparsers.add_parser("batch-invisible", help="Add invisible LSB watermarks to many images (PNG output).")
+    add_batch_arguments(batch_invisible_parser)
+    batch_invisible_parser.add_argument("--message", help="Secret text message to encode.")
+    batch_invisible_parser.add_argument("--file", help="Path to file containing data to encode.")
+    batch_invisible_parser.add_argument("--strength", type=int, default=3, choices=range(1, 6),
+                                        help="Encoding strength (1-5). Higher values use more bits. Default: %(default)s")
+    batch_invisible_parser.add_argument("--legacy-format", action="store_true",
+                                        help="Write the old delimiter-terminated format instead of the v2 header format.")
+    batch_invisible_parser.add_argument("--compression", default="none", choices=["auto"] + available_codecs(),
+                                        help="Compress the payload before embedding; 'auto' keeps the smallest result. Default: %(default)s")
+    batch_invisible_parser.add_argument("--key", help="Secret key: scatter the watermarks over the whole image in a keyed order.")
+    batch_invisible_parser.add_argument("--output-profile", default="balanced", choices=list(OUTPUT_PROFILES),
+                                        help="Encoder settings for the output images (default: %(default)s).\n"
+                                             "'smallest' writes lossless WebP where Pillow supports it.")
+    batch_invisible_parser.set_defaults(func=cli_batch_invisible)
+
+    batch_decode_parser = subparsers.add_parser("batch-decode", help="Extract hidden data from many images (one .bin file each).")
+    add_batch_arguments(batch_decode_parser)
+    batch_decode_parser.add_argument("--strength", type=_strength_arg, default=3,
+                                     help="Decoding strength (1-5) or 'auto' to detect it per image. Default: %(default)s")
+    batch_decode_parser.add_argument("--no-legacy", dest="allow_legacy", action="store_false",
+                                     help="Only accept v2 header images; skip the full-image scan for the legacy delimiter.")
+    batch_decode_parser.add_argument("--key", help="Key the watermarks were embedded with, if any.")
+    batch_decode_parser.set_defaults(func=cli_batch_decode)
+
+    # --- Benchmark arguments ---
+    bench_parser = subparsers.add_parser("bench", help="Benchmark encode/decode/visible paths on synthetic images.")
+    bench_parser.add_argument("--resolutions", type=_resolution_arg, default=list(BENCH_RESOLUTIONS),
+                              help="Comma-separated WIDTHxHEIGHT list (default: 640x480,1920x1080,4000x3000).")
+    bench_parser.add_argument("--repeats", type=int, default=5, help="Timed runs per case (default: %(default)s).")
+    bench_parser.add_argument("--payload-size", type=int, default=1024,
+                              help="Bytes hidden per LSB encode (default: %(default)s).")
+    bench_parser.add_argument("--output", help="Write results as JSON to this file.")
+    bench_parser.add_argument("--baseline", help="JSON results to compare against; exits with 1 on regressions.")
+    bench_parser.add_argument("--threshold", type=float, default=0.10,
+                              help="Allowed p50 slowdown against the baseline as a fraction (default: %(default)s).")
+    bench_parser.set_defaults(func=cli_bench)
+
+    bench_output_parser = subparsers.add_parser("bench-output", help="Compare encode time and size of the output profiles on an image.")
+    bench_output_parser.add_argument("input", help="Image to encode.")
+    bench_output_parser.add_argument("--formats", type=_output_formats_arg, default=["PNG", "JPEG", "WEBP"],
+                                     help="Comma-separated output formats (default: PNG,JPEG,WEBP).")
+    bench_output_parser.add_argument("--strength", type=int, choices=range(1, 6),
+                                     help="Fill the image with an invisible watermark of this strength first.")
+    bench_output_parser.add_argument("--repeats", type=int, default=3, help="Timed runs per case (default: %(default)s).")
+    bench_output_parser.add_argument("--output", help="Write results as JSON to this file.")
+    bench_output_parser.set_defaults(func=cli_bench_output)
+
     # --- Web server arguments ---
     web_parser = subparsers.add_parser("web", help="Start web server interface.")
+    web_parser.add_argument("--host", default="0.0.0.0", help="Address to listen on (default: %(default)s).")
+    web_parser.add_argument("--port", type=int, default=5000, help="Port to listen on (default: %(default)s).")
+    web_parser.add_argument("--workers", type=int, default=None,
+                            help="Run the production server with this many worker processes.\n"
+                                 "Without it the Flask development server is used.")
+    web_parser.add_argument("--threads", type=int, default=4,
+                            help="Request threads per worker (default: %(default)s).")
+    web_parser.add_argument("--queue-size", type=int, default=16,
+                            help="Accepted requests per worker waiting for a thread (default: %(default)s).")
+    web_parser.add_argument("--backlog", type=int, default=128,
+                            help="Listen backlog for connections not yet accepted (default: %(default)s).")
+    web_parser.add_argument("--max-requests", type=int, default=0,
+                            help="Recycle a worker after this many requests, 0 = never (default: %(default)s).")
+    web_parser.add_argument("--graceful-timeout", type=float, default=30,
+                            help="Seconds to let in-flight requests finish on shutdown (default: %(default)s).")
     web_parser.set_defaults(func=run_web_server)
     
     args = parser.parse_args()
@@ -106,6 +106,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const extractionStrength = document.getElementById('extractionStrength');
     const extractionStrengthValue = document.getElementById('extractionStrengthValue');
     const extractLsbBitsValue = document.getElementById('extractLsbBitsValue');
+    const extractAutoStrength = document.getElementById('extractAutoStrength');
     const extractWatermarkBtn = document.getElementById('extract-watermark-btn');
     const extractionResult = document.getElementById('extraction-result');
     const extractedContent = document.getElementById('extracted-content');
@@ -133,6 +134,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let isTilingEnabled = false; // Track tiling state
     let isProcessingApply = false; // Prevent concurrent applies
     let isProcessingExtract = false; // Prevent concurrent extracts
+    let tilePreviewBlobUrl = null; // Server-rendered preview of a tiled watermark
+    let tilePreviewTimer = null; // Debounces preview requests while sliders move
+    let tilePreviewController = null; // Aborts a preview request made stale by newer settings
 
     // ---------- Helper Functions ----------
     const getLsbBits = (strength) => Math.min(8, Math.max(1, Math.ceil(parseInt(strength) * 8 / 5)));
@@ -190,6 +194,9 @@ document.addEventListener('DOMContentLoaded', () => {
     };
 
     const resetPreviewArea = () => {
+        clearTimeout(tilePreviewTimer);
+        if (tilePreviewBlobUrl) { URL.revokeObjectURL(tilePreviewBlobUrl); }
+        tilePreviewBlobUrl = null;
         previewImage.src = '';
         previewImage.removeAttribute('style');
         previewWrapper.classList.add('hidden');
@@ -236,6 +243,7 @@ document.addEventListener('DOMContentLoaded', () => {
         textColor.value = '#ffffff';
         encodingStrength.value = 3; encodingStrengthValue.textContent = '3'; lsbBitsValue.textContent = getLsbBits(3);
         extractionStrength.value = 3; extractionStrengthValue.textContent = '3';
+        extractAutoStrength.checked = false; extractionStrength.disabled = false;
         extractLsbBitsValue.textContent = getLsbBits(3);
         positionBtns.forEach(b => b.classList.remove('active'));
         const centerBtn = document.querySelector('.position-btn[data-position="center"]');
@@ -273,6 +281,15 @@ document.addEventListener('DOMContentLoaded', () => {
         if (currentWatermarkType === 'visible-logo' && !logoImageDataUrl) {
              return;
         }
+        if (isTilingActive()) { // Tile layouts are rendered by the backend (/preview)
+            scheduleTilePreview();
+            return;
+        }
+        if (tilePreviewBlobUrl && previewImage.src === tilePreviewBlobUrl) { // Back from tiling: show the original again
+            previewImage.onload = () => { updatePreviewWatermark(); previewImage.onload = null; };
+            previewImage.src = originalImageDataUrl;
+            return;
+        }
 
         const imgElement = previewImage;
         const container = previewWrapper;
@@ -336,6 +353,41 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // ---------- Tiled Watermark Preview (server-rendered) ----------
+    const isTilingActive = () => currentWatermarkType.startsWith('visible') && tileStyleSelect && tileStyleSelect.value !== 'none';
+
+    const scheduleTilePreview = () => {
+        clearTimeout(tilePreviewTimer);
+        tilePreviewTimer = setTimeout(fetchTilePreview, 250);
+    };
+
+    async function fetchTilePreview() {
+        if (!originalImageFile || !isTilingActive()) return;
+        if (currentWatermarkType === 'visible-logo' && !logoImageFile) return;
+        if (tilePreviewController) tilePreviewController.abort();
+        tilePreviewController = new AbortController();
+
+        const formData = new FormData();
+        formData.append('image', originalImageFile);
+        formData.append('visibility', 'visible');
+        formData.append('watermark_type', currentWatermarkType === 'visible-logo' ? 'logo' : 'text');
+        appendVisibleOptions(formData);
+        // Render at the displayed size (in device pixels), within the backend limit
+        const displaySize = Math.max(previewWrapper.clientWidth, previewWrapper.clientHeight) * (window.devicePixelRatio || 1);
+        formData.append('max_size', Math.min(1024, Math.max(16, Math.round(displaySize) || 512)));
+
+        try {
+            const response = await fetch('/preview', { method: 'POST', body: formData, signal: tilePreviewController.signal });
+            if (!response.ok || !isTilingActive()) return;
+            const blob = await response.blob();
+            if (tilePreviewBlobUrl) URL.revokeObjectURL(tilePreviewBlobUrl);
+            tilePreviewBlobUrl = URL.createObjectURL(blob);
+            previewImage.src = tilePreviewBlobUrl;
+        } catch (error) {
+            if (error.name !== 'AbortError') console.error("Tile Preview Fetch Error:", error);
+        }
+    }
+
      function positionAndShowOverlay(overlay, wmWidth, wmHeight, imgRect, containerRect, padding) {
          const offsetX = (containerRect.width - imgRect.width) / 2;
          const offsetY = (containerRect.height - imgRect.height) / 2;
@@ -494,8 +546,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // Invalidate backend result if tiling style changes
             if (watermarkedBlobUrl) { URL.revokeObjectURL(watermarkedBlobUrl); watermarkedBlobUrl = null; }
             downloadBtn.disabled = true;
-            // Note: Live preview for tiling/angle/spacing is complex and not implemented here.
-            // updatePreviewWatermark(); // Optionally update preview, but it won't reflect tiling changes
+            updatePreviewWatermark(); // Tile layouts are previewed by the backend
         });
     }
 
@@ -505,6 +556,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // Invalidate backend result if spacing changes
             if (watermarkedBlobUrl) { URL.revokeObjectURL(watermarkedBlobUrl); watermarkedBlobUrl = null; }
             downloadBtn.disabled = true;
+            updatePreviewWatermark();
         });
     }
 
@@ -514,6 +566,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // Invalidate backend result if angle changes
             if (watermarkedBlobUrl) { URL.revokeObjectURL(watermarkedBlobUrl); watermarkedBlobUrl = null; }
             downloadBtn.disabled = true;
+            updatePreviewWatermark();
         });
     }
 
@@ -544,6 +597,42 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     });
 
+    // Appends the visible watermark settings (style, text/logo, tiling) to a /watermark or /preview request
+    function appendVisibleOptions(formData) {
+        formData.append('opacity', (parseFloat(opacity.value) / 100.0).toFixed(2));
+        // formData.append('position', currentPosition); // Only send position if not tiling (handled below)
+
+        if (currentWatermarkType === 'visible-text') {
+             formData.append('watermark_text', watermarkText.value);
+             formData.append('text_color', textColor.value);
+        } else if (currentWatermarkType === 'visible-logo' && logoImageFile) {
+             formData.append('watermark_logo', logoImageFile);
+             // Send logo scale (assuming slider exists and is referenced as logoScaleSlider)
+             const logoScaleSlider = document.getElementById('logoScale'); // Get ref if not cached
+             if (logoScaleSlider) {
+                formData.append('logo_scale', (parseFloat(logoScaleSlider.value) / 100.0).toFixed(2));
+             }
+        }
+
+        // --- Add Tiling Data (NEW/UPDATED) ---
+        const currentTileStyle = tileStyleSelect ? tileStyleSelect.value : 'none';
+        formData.append('tile_style', currentTileStyle);
+
+        if (currentTileStyle === 'none') {
+            formData.append('position', currentPosition); // Send position only if not tiling
+        } else {
+            // Send spacing (convert 0-100% to 0.0-1.0)
+            if (tileSpacingSlider) {
+                formData.append('tile_spacing', (parseFloat(tileSpacingSlider.value) / 100.0).toFixed(2));
+            }
+            // Send angle only if style is diagonal
+            if (currentTileStyle === 'diagonal' && tileAngleSlider) {
+                formData.append('tile_angle', tileAngleSlider.value);
+            }
+        }
+        // --- End Tiling Data ---
+    }
+
     // --- Apply Watermark - ACTUAL Fetch Call ---
     applyWatermarkBtn.addEventListener('click', async () => {
         if (isProcessingApply || !originalImageFile) return;
@@ -589,41 +678,7 @@ document.addEventListener('DOMContentLoaded', () => {
             //     formData.append('watermark_logo', invisibleLogoFile);
             // }
         } else { // Visible Watermark Logic
-            formData.append('opacity', (parseFloat(opacity.value) / 100.0).toFixed(2));
-            // formData.append('position', currentPosition); // Only send position if not tiling (handled below)
-
-            if (currentWatermarkType === 'visible-text') {
-                 formData.append('watermark_text', watermarkText.value);
-                 formData.append('text_color', textColor.value);
-            } else if (currentWatermarkType === 'visible-logo' && logoImageFile) {
-                 formData.append('watermark_logo', logoImageFile);
-                 // Send logo scale (assuming slider exists and is referenced as logoScaleSlider)
-                 const logoScaleSlider = document.getElementById('logoScale'); // Get ref if not cached
-                 if (logoScaleSlider) {
-                    formData.append('logo_scale', (parseFloat(logoScaleSlider.value) / 100.0).toFixed(2));
-                 }
-            }
-
-            // --- Add Tiling Data (NEW/UPDATED) ---
-            const currentTileStyle = tileStyleSelect ? tileStyleSelect.value : 'none';
-            formData.append('tile_style', currentTileStyle);
-
-            if (currentTileStyle === 'none') {
-                formData.append('position', currentPosition); // Send position only if not tiling
-            } else {
-                // Send spacing (convert 0-100% to 0.0-1.0)
-                if (tileSpacingSlider) {
-                    formData.append('tile_spacing', (parseFloat(tileSpacingSlider.value) / 100.0).toFixed(2));
-                }
-                // Send angle only if style is diagonal
-                if (currentTileStyle === 'diagonal' && tileAngleSlider) {
-                    formData.append('tile_angle', tileAngleSlider.value);
-                }
-            }
-            // --- End Tiling Data ---
-
-            // Remove old 'tile' boolean if it exists in the original code
-            // formData.append('tile', isTilingEnabled); // <-- REMOVE THIS LINE
+            appendVisibleOptions(formData);
         }
 
         try {
@@ -708,6 +763,11 @@ document.addEventListener('DOMContentLoaded', () => {
          }
      });
 
+    extractAutoStrength.addEventListener('change', () => {
+        // The backend detects the strength itself, so the slider is only informative
+        extractionStrength.disabled = extractAutoStrength.checked;
+    });
+
     // --- Extract Watermark - ACTUAL Fetch Call ---
     extractWatermarkBtn.addEventListener('click', async () => {
         const file = extractImageUpload.files?.[0];
@@ -729,7 +789,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // Field name 'image' matches the HTML input and backend expectation
         formData.append('image', file);
          // Field name 'strength' matches the HTML input and backend expectation
-        formData.append('strength', extractionStrength.value);
+        formData.append('strength', extractAutoStrength.checked ? 'auto' : extractionStrength.value);
 
         try {
             await new Promise(resolve => setTimeout(resolve, 300));
@@ -751,6 +811,12 @@ document.addEventListener('DOMContentLoaded', () => {
             if (response.ok) {
                 // --- SUCCESSFUL EXTRACTION ---
                 setStatus(extractStatus, 'Extraction complete.', 'success');
+                if (extractAutoStrength.checked && resultData.strength) {
+                    // Reflect the detected strength on the slider
+                    extractionStrength.value = resultData.strength;
+                    extractionStrengthValue.textContent = resultData.strength;
+                    extractLsbBitsValue.textContent = getLsbBits(resultData.strength);
+                }
                 setProgress(extractProgressBar, extractProgressContainer, 100, 'success');
 
                 // Explicitly check the type and content of extracted_text
@@ -0,0 +1,56 @@
+import io
+import json
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import app as stegamark # noqa: E402
+
+
+def _png_upload(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (50, 90, 120)).save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+
+def test_tiled_watermark_with_spacing_larger_than_image():
+    client = stegamark.app.test_client()
+    for tile_spacing in ("1000", "5000"):
+        response = client.post("/watermark", data={
+            "image": (_png_upload(800, 600), "photo.png"),
+            "watermark_type": "text", "watermark_text": "StegaMark",
+            "tile_style": "grid", "tile_spacing": tile_spacing,
+        })
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).size == (800, 600)
+
+    image = Image.new("RGB", (300, 200), (10, 20, 30))
+    for tile_style in ("grid", "staggered", "diagonal"):
+        result = stegamark.add_visible_watermark(image.copy(), text="Hello", tile_style=tile_style, tile_spacing=5000)
+        assert result.size == (300, 200)
+
+
+def test_capacity_web_and_cli_report_same_compressed_size(tmp_path, capsys, monkeypatch):
+    payload = b"StegaMark capacity report " * 40
+    image_path = tmp_path / "photo.png"
+    payload_path = tmp_path / "payload.bin"
+    Image.new("RGB", (320, 240)).save(image_path)
+    payload_path.write_bytes(payload)
+
+    client = stegamark.app.test_client()
+    response = client.post("/capacity", data={
+        "image": (_png_upload(320, 240), "photo.png"),
+        "payload": (io.BytesIO(payload), "payload.bin"),
+    })
+    assert response.status_code == 200
+    web_report = response.get_json()
+
+    monkeypatch.setattr(sys, "argv", ["app.py", "capacity", str(image_path), "--file", str(payload_path), "--json"])
+    stegamark.main()
+    cli_report = json.loads(capsys.readouterr().out)
+
+    assert web_report["payload"] == cli_report["payload"]
+    assert web_report["payload"]["compressed_bytes"] < len(payload)